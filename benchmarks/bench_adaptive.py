@@ -0,0 +1,78 @@
+"""Measure ``AdaptiveMatcher`` against a poorly guessed predicate order.
+
+Builds one dispatch of candidates which each combine a costly predicate
+that rarely rejects (a regular expression matched against the request's
+user agent) with a cheap request parameter predicate, registered in that
+order, and times lookups satisfied by the last candidate with the plain
+ordered scan and with ``AdaptiveMatcher`` once it has reordered the
+predicates::
+
+    python benchmarks/bench_adaptive.py [candidates]
+
+"""
+import re
+import sys
+import timeit
+
+from walkabout import AdaptiveMatcher
+from walkabout import PredicateDispatch
+from walkabout import PredicateList
+
+from bench_match import Request
+from bench_match import RequestParamPredicate
+
+
+class UserAgentPredicate(object):
+    def __init__(self, val, config):
+        self.val = val
+        self.pattern = re.compile(val)
+
+    def text(self):
+        return 'user_agent = %s' % (self.val,)
+
+    phash = text
+
+    def __call__(self, request):
+        return self.pattern.search(request.user_agent) is not None
+
+
+def build(count):
+    predicates = PredicateList()
+    predicates.add('user_agent', UserAgentPredicate)
+    predicates.add('request_param', RequestParamPredicate)
+    by_phash = {}
+    dispatch = PredicateDispatch('view')
+    for i in range(count):
+        order, preds, phash = predicates.make(
+            None,
+            user_agent=r'(Mozilla|Chrome|Safari)/\d+.*%d' % (i % 10),
+            request_param='p%d' % i,
+        )
+        by_phash[phash] = preds
+        dispatch.add('view%d' % i, order, phash)
+    return dispatch, by_phash
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 200
+    dispatch, by_phash = build(count)
+    request = Request('GET', 'text/html', {'p%d' % (count - 1): '1'})
+    request.user_agent = 'Mozilla/5.0 (X11; Linux x86_64) ' * 4 + '0123456789'
+    matcher = AdaptiveMatcher(dispatch, by_phash)
+    for i in range(matcher.sample * matcher.interval):
+        matcher(request)
+    expected = dispatch.match(by_phash, request)
+    print('%d candidates' % count)
+    print('%20s %14s' % ('engine', 'usec/lookup'))
+    engines = [
+        ('scan', lambda: dispatch._scan(by_phash, (request,))),
+        ('AdaptiveMatcher', lambda: matcher(request)),
+    ]
+    for name, call in engines:
+        assert call() == expected, name
+        number, elapsed = timeit.Timer(call).autorange()
+        print('%20s %14.3f' % (name, elapsed / number * 1e6))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,141 @@
+"""Measure the memory forked workers stop sharing with their parent.
+
+Builds a domain of "view" candidates for a number of context interfaces
+(see ``bench_memory.py``) in the parent process, warms its caches with one
+lookup per context and view name, then forks workers which each run the
+same lookups a number of times followed by a garbage collection, and
+reports how much each worker's USS (its private memory, as read from
+``/proc/self/smaps_rollup``) grew after the lookups and after the
+collection.  The domain is left unfrozen, frozen, frozen with
+``pack=True``, or prepared with ``prefork``.  Linux only::
+
+    python benchmarks/bench_fork.py [candidates] [rounds]
+
+"""
+import gc
+import os
+import sys
+
+from zope.interface import Interface
+from zope.interface import implementer
+from zope.interface.interface import InterfaceClass
+from zope.interface.registry import Components
+
+from walkabout import PredicateDomain
+from walkabout import prefork
+
+from bench_match import ACCEPTS
+from bench_match import METHODS
+from bench_match import AcceptPredicate
+from bench_match import Request
+from bench_match import RequestMethodPredicate
+from bench_match import RequestParamPredicate
+
+
+class IView(Interface):
+    pass
+
+
+CONTEXTS = 50
+NAMES = 10
+WORKERS = 4
+
+
+def build(count):
+    domain = PredicateDomain(IView, Components())
+    domain.add_predicate('request_method', RequestMethodPredicate)
+    domain.add_predicate('accept', AcceptPredicate)
+    domain.add_predicate('request_param', RequestParamPredicate)
+    contexts = []
+    for i in range(CONTEXTS):
+        iface = InterfaceClass('IContext%d' % i)
+        contexts.append(implementer(iface)(type('Context%d' % i, (), {}))())
+        for j in range(count // CONTEXTS):
+            domain.add_candidate(
+                'view%d' % j,
+                iface,
+                name='view%d' % (j % NAMES),
+                request_method=METHODS[j % len(METHODS)],
+                accept=ACCEPTS[j % len(ACCEPTS)],
+                request_param='p%d' % j,
+            )
+    return domain, contexts
+
+
+def lookups(domain, contexts, request):
+    # no candidate requires an empty request_param, so every query goes
+    # through the whole dispatch
+    query = domain.query
+    for context in contexts:
+        for j in range(NAMES):
+            query(context, request, name='view%d' % j)
+
+
+def uss():
+    # kB of private (unshared) memory
+    fields = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1])
+    return fields['Private_Clean'] + fields['Private_Dirty']
+
+
+def worker(domain, contexts, request, rounds, fd):
+    start = uss()
+    for i in range(rounds):
+        lookups(domain, contexts, request)
+    looked_up = uss()
+    gc.collect()
+    collected = uss()
+    os.write(fd, ('%d %d\n' % (looked_up - start, collected - start)).encode())
+    os._exit(0)
+
+
+def run(mode, count, rounds):
+    domain, contexts = build(count)
+    request = Request('GET', 'text/html', {})
+    lookups(domain, contexts, request)
+    if mode == 'frozen':
+        domain.freeze()
+        lookups(domain, contexts, request)
+    elif mode == 'packed':
+        domain.freeze(pack=True)
+        lookups(domain, contexts, request)
+    elif mode == 'prefork':
+        domain.freeze(pack=True)
+        lookups(domain, contexts, request)
+        prefork(domain)
+    read, write = os.pipe()
+    pids = []
+    for i in range(WORKERS):
+        pid = os.fork()
+        if pid == 0:
+            os.close(read)
+            worker(domain, contexts, request, rounds, write)
+        pids.append(pid)
+    os.close(write)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    with os.fdopen(read) as f:
+        results = [tuple(map(int, line.split())) for line in f]
+    if mode == 'prefork':
+        gc.unfreeze()
+    return (sum(looked_up for looked_up, collected in results) / WORKERS,
+            sum(collected for looked_up, collected in results) / WORKERS)
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 20000
+    rounds = int(argv[2]) if len(argv) > 2 else 10
+    print('%d candidates, %d lookups per worker' % (
+        count, rounds * CONTEXTS * NAMES))
+    print('%10s %18s %18s' % ('mode', 'kB after lookups', 'kB after gc'))
+    for mode in ('unfrozen', 'frozen', 'packed', 'prefork'):
+        looked_up, collected = run(mode, count, rounds)
+        print('%10s %18.0f %18.0f' % (mode, looked_up, collected))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,69 @@
+"""Compare ``PredicateDomain.lookup`` through the available indexes.
+
+Registers one unpredicated candidate for each of a number of interfaces
+and times lookups for objects of a class implementing the last one,
+before and after freezing the domain::
+
+    python benchmarks/bench_lookup.py [interfaces]
+
+"""
+import sys
+import timeit
+
+from zope.interface import Interface
+from zope.interface import implementer
+from zope.interface import providedBy
+from zope.interface.interface import InterfaceClass
+from zope.interface.registry import Components
+
+from walkabout import PredicateDomain
+from walkabout import RegistryIndex
+from walkabout import SpecIndex
+
+
+class ITarget(Interface):
+    pass
+
+
+def build(count, index):
+    domain = PredicateDomain(ITarget, Components(), index=index)
+    base = Interface
+    for i in range(count):
+        base = InterfaceClass('I%d' % i, (base,))
+        domain.add_candidate('candidate%d' % i, base)
+
+    @implementer(base)
+    class Context(object):
+        pass
+
+    return domain, Context()
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 50
+    print('%d interfaces' % count)
+    print('%20s %14s' % ('index', 'usec/lookup'))
+    for name, index in [('RegistryIndex', RegistryIndex),
+                        ('SpecIndex', SpecIndex)]:
+        domain, context = build(count, index)
+        if name == 'RegistryIndex':
+            adapters = domain.registry.adapters
+            def uncached():
+                dispatch = adapters.lookup(
+                    (providedBy(context),), ITarget, name='')
+                return dispatch.match(domain.by_phash, context)
+            assert uncached() == domain.lookup(context)
+            number, elapsed = timeit.Timer(uncached).autorange()
+            print('%20s %14.3f' % ('uncached', elapsed / number * 1e6))
+        call = lambda: domain.lookup(context)
+        assert call() == 'candidate%d' % (count - 1), name
+        number, elapsed = timeit.Timer(call).autorange()
+        print('%20s %14.3f' % (name, elapsed / number * 1e6))
+        domain.freeze()
+        assert call() == 'candidate%d' % (count - 1), name
+        number, elapsed = timeit.Timer(call).autorange()
+        print('%20s %14.3f' % (name + ' frozen', elapsed / number * 1e6))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
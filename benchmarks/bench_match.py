@@ -0,0 +1,128 @@
+"""Compare the ``PredicateDispatch`` matching engines.
+
+Builds one dispatch of "multiview" style candidates, each combining a
+request method, an accept type and a request parameter predicate, and
+times lookups which are satisfied by a candidate near the end::
+
+    python benchmarks/bench_match.py [candidates]
+
+"""
+import sys
+import timeit
+
+from walkabout import AdaptiveMatcher
+from walkabout import BitmaskMatcher
+from walkabout import FrozenDispatch
+from walkabout import KeyedMatcher
+from walkabout import PredicateDispatch
+from walkabout import PredicateList
+from walkabout import TreeMatcher
+from walkabout import compile_matcher
+
+
+class Request(object):
+    def __init__(self, method, accept, params):
+        self.method = method
+        self.accept = accept
+        self.params = params
+
+
+class RequestMethodPredicate(object):
+    def __init__(self, val, config):
+        self.val = val
+
+    def text(self):
+        return 'request_method = %s' % (self.val,)
+
+    phash = text
+
+    def dispatch_key(self, request):
+        return request.method
+
+    def __call__(self, request):
+        return request.method == self.val
+
+
+class AcceptPredicate(object):
+    def __init__(self, val, config):
+        self.val = val
+
+    def text(self):
+        return 'accept = %s' % (self.val,)
+
+    phash = text
+
+    def __call__(self, request):
+        return self.val == request.accept
+
+
+class RequestParamPredicate(object):
+    def __init__(self, val, config):
+        self.val = val
+
+    def text(self):
+        return 'request_param %s' % (self.val,)
+
+    phash = text
+
+    def __call__(self, request):
+        return self.val in request.params
+
+
+METHODS = ['GET', 'POST', 'PUT', 'DELETE', 'PATCH']
+ACCEPTS = ['text/html', 'application/json', 'text/plain', 'application/xml']
+
+
+def build(count, keyed=False):
+    predicates = PredicateList(keyed=keyed)
+    predicates.add('request_method', RequestMethodPredicate)
+    predicates.add('accept', AcceptPredicate)
+    predicates.add('request_param', RequestParamPredicate)
+    by_phash = {}
+    dispatch = PredicateDispatch('view')
+    for i in range(count):
+        order, preds, phash = predicates.make(
+            None,
+            request_method=METHODS[i % len(METHODS)],
+            accept=ACCEPTS[(i // len(METHODS)) % len(ACCEPTS)],
+            request_param='p%d' % i,
+        )
+        by_phash[phash] = preds
+        dispatch.add('view%d' % i, order, phash)
+    return dispatch, by_phash
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 200
+    dispatch, by_phash = build(count)
+    keyed_dispatch, keyed_by_phash = build(count, keyed=True)
+    last = count - 1
+    request = Request(
+        METHODS[last % len(METHODS)],
+        ACCEPTS[(last // len(METHODS)) % len(ACCEPTS)],
+        {'p%d' % last: '1'},
+    )
+    engines = [
+        ('scan', dispatch._scan),
+        ('TreeMatcher', TreeMatcher(dispatch, by_phash)),
+        ('BitmaskMatcher', BitmaskMatcher(dispatch, by_phash)),
+        ('KeyedMatcher', KeyedMatcher(keyed_dispatch, keyed_by_phash)),
+        ('compile_matcher', compile_matcher(dispatch, by_phash)),
+        ('FrozenDispatch', FrozenDispatch(dispatch, by_phash).select),
+        ('AdaptiveMatcher', AdaptiveMatcher(dispatch, by_phash)),
+    ]
+    expected = dispatch.match(by_phash, request)
+    print('%d candidates' % count)
+    print('%16s %14s' % ('engine', 'usec/lookup'))
+    for name, engine in engines:
+        if name == 'scan':
+            call = lambda: engine(by_phash, (request,))
+        else:
+            call = lambda: engine(request)
+        assert call() == expected, name
+        number, elapsed = timeit.Timer(call).autorange()
+        print('%16s %14.3f' % (name, elapsed / number * 1e6))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,82 @@
+"""Measure the memory used by a large ``PredicateDomain``.
+
+Registers "view" candidates for a number of context interfaces, each
+combining a request method, an accept type and a request parameter
+predicate, and reports the memory allocated while registering them (as
+traced by ``tracemalloc``) and the number of distinct predicate objects,
+for each phash strategy::
+
+    python benchmarks/bench_memory.py [candidates]
+
+"""
+import sys
+import time
+import tracemalloc
+
+from zope.interface import Interface
+from zope.interface.interface import InterfaceClass
+from zope.interface.registry import Components
+
+from walkabout import Blake2bPhash
+from walkabout import MD5Phash
+from walkabout import PredicateDomain
+
+from bench_match import ACCEPTS
+from bench_match import METHODS
+from bench_match import AcceptPredicate
+from bench_match import RequestMethodPredicate
+from bench_match import RequestParamPredicate
+
+
+class IView(Interface):
+    pass
+
+
+CONTEXTS = 50
+
+
+def build(count, phash):
+    domain = PredicateDomain(IView, Components(), phash=phash)
+    domain.add_predicate('request_method', RequestMethodPredicate)
+    domain.add_predicate('accept', AcceptPredicate)
+    domain.add_predicate('request_param', RequestParamPredicate)
+    contexts = [InterfaceClass('IContext%d' % i) for i in range(CONTEXTS)]
+    for i in range(count):
+        domain.add_candidate(
+            'view%d' % i,
+            contexts[i % CONTEXTS],
+            name='view%d' % (i // CONTEXTS % 10),
+            request_method=METHODS[i % len(METHODS)],
+            accept=ACCEPTS[i % len(ACCEPTS)],
+            request_param='p%d' % i,
+        )
+    return domain
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 5000
+    print('%d candidates' % count)
+    for phash in (Blake2bPhash, MD5Phash):
+        start = time.perf_counter()
+        build(count, phash)
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        domain = build(count, phash)
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        used = sum(
+            stat.size_diff for stat in after.compare_to(before, 'filename'))
+        predicates = set()
+        for preds in domain.by_phash.values():
+            predicates.update(id(pred) for pred in preds)
+        print(phash.__name__)
+        print('%24s %12.1f' % ('usec per candidate', elapsed / count * 1e6))
+        print('%24s %12d' % ('bytes allocated', used))
+        print('%24s %12.1f' % ('bytes per candidate', float(used) / count))
+        print('%24s %12d' % ('predicate lists', len(domain.by_phash)))
+        print('%24s %12d' % ('predicate objects', len(predicates)))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,89 @@
+"""Compare configuring a ``PredicateDomain`` with restoring a snapshot.
+
+Registers "view" candidates for a number of context interfaces (see
+``bench_memory.py``) in a batch, and times doing so against restoring a
+JSON snapshot of the result, including parsing it::
+
+    python benchmarks/bench_snapshot.py [candidates]
+
+"""
+import json
+import sys
+import time
+
+from zope.interface import Interface
+from zope.interface.interface import InterfaceClass
+from zope.interface.registry import Components
+
+from walkabout import PredicateDomain
+
+from bench_match import ACCEPTS
+from bench_match import METHODS
+from bench_match import AcceptPredicate
+from bench_match import RequestMethodPredicate
+from bench_match import RequestParamPredicate
+
+
+class IView(Interface):
+    pass
+
+
+CONTEXTS = 50
+
+# snapshots refer to the contexts and views by their dotted names
+CONTEXT_INTERFACES = []
+for i in range(CONTEXTS):
+    iface = InterfaceClass('IContext%d' % i, __module__=__name__)
+    globals()[iface.__name__] = iface
+    CONTEXT_INTERFACES.append(iface)
+
+
+def view():
+    pass
+
+
+def make_domain(record=False):
+    domain = PredicateDomain(IView, Components(), record=record)
+    domain.add_predicate('request_method', RequestMethodPredicate)
+    domain.add_predicate('accept', AcceptPredicate)
+    domain.add_predicate('request_param', RequestParamPredicate)
+    return domain
+
+
+def configure(domain, count):
+    with domain.batch():
+        for i in range(count):
+            domain.add_candidate(
+                view,
+                CONTEXT_INTERFACES[i % CONTEXTS],
+                name='view%d' % (i // CONTEXTS % 10),
+                request_method=METHODS[i % len(METHODS)],
+                accept=ACCEPTS[i % len(ACCEPTS)],
+                request_param='p%d' % i,
+            )
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 20000
+    print('%d candidates' % count)
+    domain = make_domain(record=True)
+    configure(domain, count)
+    data = json.dumps(domain.snapshot('fingerprint'))
+    print('%24s %12d' % ('snapshot bytes', len(data)))
+
+    start = time.perf_counter()
+    configured = make_domain()
+    configure(configured, count)
+    elapsed = time.perf_counter() - start
+    print('%24s %12.1f' % ('configure msec', elapsed * 1e3))
+
+    start = time.perf_counter()
+    restored = make_domain()
+    assert restored.restore(json.loads(data), 'fingerprint')
+    elapsed = time.perf_counter() - start
+    print('%24s %12.1f' % ('restore msec', elapsed * 1e3))
+    assert restored.by_phash.keys() == configured.by_phash.keys()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
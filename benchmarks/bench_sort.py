@@ -0,0 +1,50 @@
+"""Scaling benchmark for ``walkabout.TopologicalSorter.sorted``.
+
+Builds sort inputs of increasing size, where each node is ordered after a
+randomly chosen earlier node (plus the default ``before=LAST``), and times
+an uncached sort of each::
+
+    python benchmarks/bench_sort.py [max_nodes]
+
+"""
+import random
+import sys
+import time
+
+from walkabout import TopologicalSorter
+
+
+def build(size, seed=42):
+    rnd = random.Random(seed)
+    sorter = TopologicalSorter()
+    for i in range(size):
+        if i and rnd.random() < 0.8:
+            sorter.add('n%d' % i, i, after='n%d' % rnd.randrange(i))
+        else:
+            sorter.add('n%d' % i, i)
+    return sorter
+
+
+def measure(sorter, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        sorter._sort()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main(argv):
+    max_nodes = int(argv[1]) if len(argv) > 1 else 100000
+    print('%10s %12s %12s' % ('nodes', 'seconds', 'usec/node'))
+    size = 10
+    while size <= max_nodes:
+        elapsed = measure(build(size))
+        print('%10d %12.6f %12.3f' % (size, elapsed, elapsed / size * 1e6))
+        size *= 10
+
+
+if __name__ == '__main__':
+    main(sys.argv)
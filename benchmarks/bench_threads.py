@@ -0,0 +1,101 @@
+"""Measure ``PredicateDomain.lookup`` throughput across threads.
+
+Runs the same number of lookups per thread against a shared domain of
+"view" candidates (see ``bench_match.py``) with 1 to 32 threads, while
+another thread keeps registering candidates under a different name, and
+reports the total number of lookups per second.  Lookups only scale with
+the number of threads on a free-threaded (3.13t+) build::
+
+    python benchmarks/bench_threads.py [lookups per thread]
+
+"""
+import sys
+import threading
+import time
+
+from zope.interface import Interface
+from zope.interface import implementer
+from zope.interface.registry import Components
+
+from walkabout import PredicateDomain
+
+from bench_match import ACCEPTS
+from bench_match import METHODS
+from bench_match import AcceptPredicate
+from bench_match import Request
+from bench_match import RequestMethodPredicate
+from bench_match import RequestParamPredicate
+
+
+class IView(Interface):
+    pass
+
+
+class IRequest(Interface):
+    pass
+
+
+@implementer(IRequest)
+class DummyRequest(Request):
+    pass
+
+
+def build(count):
+    domain = PredicateDomain(IView, Components())
+    domain.add_predicate('request_method', RequestMethodPredicate)
+    domain.add_predicate('accept', AcceptPredicate)
+    domain.add_predicate('request_param', RequestParamPredicate)
+    for i in range(count):
+        domain.add_candidate(
+            'view%d' % i,
+            IRequest,
+            request_method=METHODS[i % len(METHODS)],
+            accept=ACCEPTS[(i // len(METHODS)) % len(ACCEPTS)],
+            request_param='p%d' % i,
+        )
+    return domain
+
+
+def run(domain, threads, lookups):
+    request = DummyRequest('GET', 'text/html', {'p0': '1'})
+    done = threading.Event()
+
+    def register():
+        i = 0
+        while not done.is_set():
+            domain.add_candidate(
+                'late%d' % i, IRequest, name='late', request_param='q%d' % i)
+            i += 1
+            time.sleep(0.001)
+
+    def read():
+        lookup = domain.lookup
+        for i in range(lookups):
+            lookup(request)
+
+    writer = threading.Thread(target=register)
+    readers = [threading.Thread(target=read) for i in range(threads)]
+    writer.start()
+    start = time.perf_counter()
+    for thread in readers:
+        thread.start()
+    for thread in readers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    done.set()
+    writer.join()
+    return threads * lookups / elapsed
+
+
+def main(argv):
+    lookups = int(argv[1]) if len(argv) > 1 else 20000
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', lambda: True)
+    print('GIL enabled: %s' % is_gil_enabled())
+    print('%8s %16s' % ('threads', 'lookups/sec'))
+    for threads in (1, 2, 4, 8, 16, 32):
+        domain = build(20)
+        print('%8d %16.0f' % (threads, run(domain, threads, lookups)))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,7 +1,17 @@
+import bisect
+from collections import deque
+import contextlib
+import gc
+from hashlib import blake2b
 from hashlib import md5
+import importlib
 import inspect
+import itertools
+import json
 import operator
 import sys
+import threading
+import time
 
 from zope.interface import Attribute
 from zope.interface import implementer
@@ -9,6 +19,8 @@ from zope.interface.interfaces import IInterface
 from zope.interface.interfaces import Interface
 from zope.interface import providedBy
 from zope.interface import implementedBy
+from zope.interface.declarations import ClassProvides
+from zope.interface.declarations import objectSpecificationDescriptor
 
 def is_nonstr_iter(v):
     if isinstance(v, str):
@@ -24,6 +36,8 @@ def bytes_(s, encoding='latin-1', errors='strict'):
 
 
 MAX_ORDER = 1 << 30
+# the phash of an empty predicate list with ``MD5Phash`` only; the
+# ``default`` of each phash strategy holds its own
 DEFAULT_PHASH = md5().hexdigest()
 
 class Sentinel(object):
@@ -35,6 +49,8 @@ class Sentinel(object):
 
 FIRST = Sentinel('FIRST')
 LAST = Sentinel('LAST')
+_hole = Sentinel('_hole')
+_marker = Sentinel('_marker')
 
 class SortingError(ValueError):
     """Unable to satisfy all dependencies during a topological sort.
@@ -48,6 +64,10 @@ class PredicateMismatch(LookupError):
     """No candicate's predicates match.
     """
 
+class FrozenDomainError(RuntimeError):
+    """A frozen PredicateDomain can't be changed.
+    """
+
 class predvalseq(tuple):
     """ A subtype of tuple used to represent a sequence of predicate values
     """
@@ -62,32 +82,58 @@ class TopologicalSorter(object):
         first=FIRST,
         last=LAST,
         ):
-        self.names = []
+        # ``names`` is used as an insertion-ordered set; ``order`` maps an
+        # edge id to its ``(from, to)`` arc and ``name2edges`` indexes the
+        # ids of the arcs declared by each node, so that removing a node
+        # only touches its own arcs.
+        self.names = {}
         self.req_before = set()
         self.req_after = set()
         self.name2before = {}
         self.name2after = {}
         self.name2val = {}
-        self.order = []
+        self.name2edges = {}
+        self.order = {}
+        self._edge_ids = itertools.count()
         self.default_before = default_before
         self.default_after = default_after
         self.first = first
         self.last = last
+        # ``version`` is bumped by every mutation of the sort input; the
+        # result of ``sorted`` is memoized against it.
+        self.version = 0
+        self._sorted = None
+        self._progress = None
+
+    def _changed(self):
+        self.version += 1
+        self._sorted = None
+        self._progress = None
 
     def remove(self, name):
         """ Remove a node from the sort input """
-        self.names.remove(name)
+        if name not in self.names:
+            raise ValueError('%r is not in the sort input' % (name,))
+        del self.names[name]
+        self._changed()
         del self.name2val[name]
-        after = self.name2after.pop(name, [])
-        if after:
-            self.req_after.remove(name)
-            for u in after:
-                self.order.remove((u, name))
-        before = self.name2before.pop(name, [])
-        if before:
-            self.req_before.remove(name)
-            for u in before:
-                self.order.remove((name, u))
+        self.name2after.pop(name, None)
+        self.name2before.pop(name, None)
+        self.req_after.discard(name)
+        self.req_before.discard(name)
+        order = self.order
+        for edge in self.name2edges.pop(name, ()):
+            del order[edge]
+
+    def _add_node(self, name, val):
+        self.names[name] = None
+        self.name2val[name] = val
+        self.name2edges[name] = []
+
+    def _add_edge(self, name, fromnode, tonode):
+        edge = next(self._edge_ids)
+        self.order[edge] = (fromnode, tonode)
+        self.name2edges[name].append(edge)
 
     def add(self, name, val, after=None, before=None):
         """ Add a node to the sort input.  The ``name`` should be a string or
@@ -110,54 +156,164 @@ class TopologicalSorter(object):
         """
         if name in self.names:
             self.remove(name)
-        self.names.append(name)
-        self.name2val[name] = val
+        self._changed()
+        self._add_node(name, val)
         if after is None and before is None:
             before = self.default_before
             after = self.default_after
         if after is not None:
             if not is_nonstr_iter(after):
                 after = (after,)
+            after = tuple(after)
             self.name2after[name] = after
-            self.order += [(u, name) for u in after]
+            for u in after:
+                self._add_edge(name, u, name)
             self.req_after.add(name)
         if before is not None:
             if not is_nonstr_iter(before):
                 before = (before,)
+            before = tuple(before)
             self.name2before[name] = before
-            self.order += [(name, o) for o in before]
+            for o in before:
+                self._add_edge(name, name, o)
             self.req_before.add(name)
 
-
     def sorted(self):
-        """ Returns the sort input values in topologically sorted order"""
-        order = [(self.first, self.last)]
-        roots = []
-        graph = {}
-        names = [self.first, self.last]
-        names.extend(self.names)
-
-        for a, b in self.order:
-            order.append((a, b))
-
-        def add_node(node):
-            if not node in graph:
-                roots.append(node)
-                graph[node] = [0] # 0 = number of arcs coming into this node
-
-        def add_arc(fromnode, tonode):
-            graph[fromnode].append(tonode)
-            graph[tonode][0] += 1
-            if tonode in roots:
-                roots.remove(tonode)
+        """ Returns the sort input values in topologically sorted order
+
+        The result is computed once and reused until the next call to
+        :meth:`add` or :meth:`remove`.
+        """
+        if self._sorted is None:
+            self._sorted = self._sort()
+        return list(self._sorted)
+
+    def sorted_layers(self):
+        """ Returns the sort input values grouped into layers.
+
+        Each layer is a list of ``(name, value)`` pairs whose dependencies
+        are all satisfied by the layers before it, so the members of a
+        layer may be processed concurrently.  ``first`` and ``last`` do not
+        occupy a layer of their own.  Within a layer, values keep the order
+        in which :meth:`sorted` returns them.
+        """
+        ordered = self.sorted()
+        graph, indegree = self._graph()
+        name2val = self.name2val
+        depth = dict.fromkeys(graph, 0)
+        roots = [node for node in graph if not indegree[node]]
+        while roots:
+            node = roots.pop()
+            # sentinels are ordering points, not work: they add no depth
+            child_depth = depth[node] + (node in name2val)
+            for child in graph[node]:
+                if depth[child] < child_depth:
+                    depth[child] = child_depth
+                indegree[child] -= 1
+                if not indegree[child]:
+                    roots.append(child)
+        layers = []
+        for name, val in ordered:
+            layer = depth[name]
+            while len(layers) <= layer:
+                layers.append([])
+            layers[layer].append((name, val))
+        return layers
+
+    def ready(self):
+        """ Returns the ``(name, value)`` pairs whose dependencies have all
+        been marked :meth:`done` and which have not been returned by an
+        earlier call.
+
+        Together with :meth:`done` and :meth:`is_active` this lets callers
+        hand values to workers as soon as they become runnable::
+
+           while sorter.is_active():
+               for name, val in sorter.ready():
+                   pool.submit(run, name, val) # calls sorter.done(name)
+               wait_for_some_work()
+
+        Calling :meth:`add` or :meth:`remove` restarts the iteration.
+        """
+        progress = self._progress
+        if progress is None:
+            progress = self._start()
+        waiting, handed_out = progress[1], progress[2]
+        name2val = self.name2val
+        result = [(name, name2val[name]) for name in waiting]
+        handed_out.update(waiting)
+        del waiting[:]
+        return result
 
+    def done(self, *names):
+        """ Mark values returned by :meth:`ready` as processed, making the
+        values which depend on them ready in turn.
+        """
+        progress = self._progress
+        if progress is None:
+            progress = self._start()
+        handed_out = progress[2]
         for name in names:
-            add_node(name)
+            if name not in handed_out:
+                raise ValueError('%r was not returned by ready()' % (name,))
+            handed_out.remove(name)
+            self._release(progress, name)
+
+    def is_active(self):
+        """ Return ``True`` while values remain to be returned by
+        :meth:`ready` or marked :meth:`done`.
+        """
+        progress = self._progress
+        if progress is None:
+            progress = self._start()
+        return bool(progress[1] or progress[2])
+
+    def _start(self):
+        ordered = self.sorted()
+        graph, indegree = self._graph()
+        progress = self._progress = (graph, [], set(), indegree)
+        position = dict((name, i) for i, (name, _) in enumerate(ordered))
+        for node in sorted(
+                [node for node in graph if not indegree[node]],
+                key=lambda node: position.get(node, -1)):
+            if node in position:
+                progress[1].append(node)
+            else:
+                self._release(progress, node)
+        return progress
+
+    def _release(self, progress, node):
+        graph, waiting, _, indegree = progress
+        name2val = self.name2val
+        for child in graph[node]:
+            indegree[child] -= 1
+            if not indegree[child]:
+                if child in name2val:
+                    waiting.append(child)
+                else:
+                    self._release(progress, child)
+
+    def _graph(self):
+        # Build the adjacency lists and in-degree counts for the nodes
+        # present in the sort input, checking that every node which asked
+        # for a before / after dependency got at least one.
+        graph = {} # node -> [child, ...]
+        indegree = {} # node -> number of arcs coming into the node
+        for node in (self.first, self.last):
+            graph[node] = []
+            indegree[node] = 0
+        for node in self.names:
+            if node not in graph:
+                graph[node] = []
+                indegree[node] = 0
 
         has_before, has_after = set(), set()
-        for a, b in order:
-            if a in names and b in names: # deal with missing dependencies
-                add_arc(a, b)
+        arcs = [(self.first, self.last)]
+        arcs.extend(self.order.values())
+        for a, b in arcs:
+            if a in graph and b in graph: # deal with missing dependencies
+                graph[a].append(b)
+                indegree[b] += 1
                 has_before.add(a)
                 has_after.add(b)
 
@@ -171,35 +327,202 @@ class TopologicalSorter(object):
                 'Unsatisfied after dependencies: %s'
                 % (', '.join(sorted(self.req_after - has_after)))
             )
-
+        return graph, indegree
+
+    def _sort(self):
+        # Kahn's algorithm.  Nodes whose last incoming arc is removed are
+        # pushed onto the *front* of the frontier, so ties are broken
+        # depth-first in insertion order.
+        graph, indegree = self._graph()
+        roots = deque([node for node in graph if not indegree[node]])
         sorted_names = []
 
         while roots:
-            root = roots.pop(0)
+            root = roots.popleft()
             sorted_names.append(root)
-            children = graph[root][1:]
-            for child in children:
-                arcs = graph[child][0]
-                arcs -= 1
-                graph[child][0] = arcs
+            for child in graph[root]:
+                arcs = indegree[child] - 1
+                indegree[child] = arcs
                 if arcs == 0:
-                    roots.insert(0, child)
-            del graph[root]
+                    roots.appendleft(child)
 
-        if graph:
+        if len(sorted_names) != len(graph):
             # loop in input
             cycledeps = {}
             for k, v in graph.items():
-                cycledeps[k] = v[1:]
+                if indegree[k]:
+                    cycledeps[k] = list(v)
             raise CyclicDependencyError(cycledeps)
 
-        result = []
+        name2val = self.name2val
+        return [
+            (name, name2val[name]) for name in sorted_names
+            if name in name2val
+        ]
 
-        for name in sorted_names:
-            if name in self.names:
-                result.append((name, self.name2val[name]))
 
-        return result
+class DynamicTopologicalSorter(TopologicalSorter):
+    """ A :class:`TopologicalSorter` which keeps its topological order up to
+    date as nodes are added and removed.
+
+    Each arc is inserted into the maintained order as it becomes active
+    (both of its ends are present), using the Pearce-Kelly algorithm: only
+    the nodes lying between the two ends of an arc which violates the
+    current order are visited and reordered.  A
+    :exc:`CyclicDependencyError` is therefore raised by the :meth:`add`
+    which closes a cycle, rather than by a later :meth:`sorted`; the
+    offending node is not added, and a registration it was replacing is
+    restored.  Removing a node never invalidates the order.
+
+    The order produced is a valid topological order, but ties are not
+    necessarily broken the same way as by :class:`TopologicalSorter`.
+    """
+    def __init__(self, *arg, **kw):
+        super(DynamicTopologicalSorter, self).__init__(*arg, **kw)
+        first, last = self.first, self.last
+        # ``_slots`` lists the present nodes in topological order (with
+        # holes left by removed nodes); ``_ord`` maps each present node to
+        # its slot.
+        self._slots = [first, last]
+        self._ord = {first: 0, last: 1}
+        self._holes = 0
+        # every declared arc, indexed by both of its ends, whether or not
+        # those ends are present yet.
+        self._out = {first: {-1: last}}
+        self._in = {last: {-1: first}}
+
+    def add(self, name, val, after=None, before=None):
+        previous = None
+        if name in self.names:
+            previous = (
+                self.name2val[name],
+                self.name2after.get(name),
+                self.name2before.get(name),
+            )
+        try:
+            super(DynamicTopologicalSorter, self).add(name, val, after, before)
+        except CyclicDependencyError:
+            self.remove(name)
+            if previous is not None:
+                super(DynamicTopologicalSorter, self).add(name, *previous)
+            raise
+
+    add.__doc__ = TopologicalSorter.add.__doc__
+
+    def remove(self, name):
+        """ Remove a node from the sort input """
+        order = self.order
+        for edge in self.name2edges.get(name, ()):
+            fromnode, tonode = order[edge]
+            del self._out[fromnode][edge]
+            del self._in[tonode][edge]
+        super(DynamicTopologicalSorter, self).remove(name)
+        slot = self._ord.pop(name)
+        self._slots[slot] = _hole
+        self._holes += 1
+        if self._holes * 2 > len(self._slots):
+            self._compact()
+
+    def _compact(self):
+        self._slots = [node for node in self._slots if node is not _hole]
+        self._ord = dict((node, i) for i, node in enumerate(self._slots))
+        self._holes = 0
+
+    def _add_node(self, name, val):
+        super(DynamicTopologicalSorter, self)._add_node(name, val)
+        self._ord[name] = len(self._slots)
+        self._slots.append(name)
+        # arcs declared by other nodes which were waiting for this one
+        present = self._ord
+        for tonode in list(self._out.get(name, {}).values()):
+            if tonode in present:
+                self._insert_arc(name, tonode)
+        for fromnode in list(self._in.get(name, {}).values()):
+            if fromnode in present:
+                self._insert_arc(fromnode, name)
+
+    def _add_edge(self, name, fromnode, tonode):
+        super(DynamicTopologicalSorter, self)._add_edge(name, fromnode, tonode)
+        edge = self.name2edges[name][-1]
+        self._out.setdefault(fromnode, {})[edge] = tonode
+        self._in.setdefault(tonode, {})[edge] = fromnode
+        present = self._ord
+        if fromnode in present and tonode in present:
+            self._insert_arc(fromnode, tonode)
+
+    def _insert_arc(self, fromnode, tonode):
+        ord = self._ord
+        lower, upper = ord[tonode], ord[fromnode]
+        if lower > upper:
+            return
+        if lower == upper:
+            raise CyclicDependencyError({fromnode: [tonode]})
+        # nodes reachable from ``tonode`` which are currently ordered before
+        # ``fromnode``; reaching ``fromnode`` itself means a cycle.
+        forward = {tonode: None}
+        stack = [tonode]
+        while stack:
+            node = stack.pop()
+            for child in self._out.get(node, {}).values():
+                if child == fromnode:
+                    cycle = [fromnode, node]
+                    while forward[node] is not None:
+                        node = forward[node]
+                        cycle.append(node)
+                    cycledeps = {}
+                    for i, node in enumerate(cycle):
+                        cycledeps[node] = [cycle[i - 1]]
+                    raise CyclicDependencyError(cycledeps)
+                if (child in ord and child not in forward and
+                        ord[child] < upper):
+                    forward[child] = node
+                    stack.append(child)
+        # nodes reaching ``fromnode`` which are currently ordered after
+        # ``tonode``.
+        backward = {fromnode: None}
+        stack = [fromnode]
+        while stack:
+            node = stack.pop()
+            for parent in self._in.get(node, {}).values():
+                if (parent in ord and parent not in backward
+                        and ord[parent] > lower):
+                    backward[parent] = None
+                    stack.append(parent)
+        # move everything reaching ``fromnode`` ahead of everything reachable
+        # from ``tonode``, reusing the slots they already occupy.
+        moved = sorted(backward, key=ord.__getitem__)
+        moved.extend(sorted(forward, key=ord.__getitem__))
+        slots = sorted([ord[node] for node in moved])
+        for slot, node in zip(slots, moved):
+            ord[node] = slot
+            self._slots[slot] = node
+
+    def _sort(self):
+        present = self._ord
+        out, in_ = self._out, self._in
+        unsatisfied = [
+            name for name in self.req_before
+            if not any(v in present for v in out.get(name, {}).values())
+        ]
+        if unsatisfied:
+            raise SortingError(
+                'Unsatisfied before dependencies: %s'
+                % (', '.join(sorted(unsatisfied)))
+            )
+        unsatisfied = [
+            name for name in self.req_after
+            if not any(u in present for u in in_.get(name, {}).values())
+        ]
+        if unsatisfied:
+            raise SortingError(
+                'Unsatisfied after dependencies: %s'
+                % (', '.join(sorted(unsatisfied)))
+            )
+        name2val = self.name2val
+        return [
+            (name, name2val[name]) for name in self._slots
+            if name is not _hole and name in name2val
+        ]
 
 
 class not_(object):
@@ -236,11 +559,14 @@ class not_(object):
 
     .. versionadded:: 1.5
     """
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
 
 class Notted(object):
+    __slots__ = ('predicate',)
 
     def __init__(self, predicate):
         self.predicate = predicate
@@ -267,18 +593,172 @@ class Notted(object):
         return result
 
 
+class Keyed(object):
+    """ Wraps a predicate which supports dispatch by key.
+
+    A predicate supports it by providing a ``dispatch_key(*args)`` method
+    such that calling the predicate is true exactly when ``dispatch_key``
+    returns (something equal to) the value the predicate was created with.
+    All predicates registered under the same name must compute the same key
+    for the same arguments.  :meth:`PredicateList.make` wraps such
+    predicates, recording their name and value, when the list is created
+    with ``keyed=True`` (as by a :class:`PredicateDomain` using
+    :class:`KeyedMatcher`), unless they are negated with :class:`not_` or
+    their value is unhashable.
+    """
+    __slots__ = ('predicate', 'name', 'value')
+
+    def __init__(self, predicate, name, value):
+        self.predicate = predicate
+        self.name = name
+        self.value = value
+
+    def text(self):
+        return self.predicate.text()
+
+    def phash(self):
+        return self.predicate.phash()
+
+    def dispatch_key(self, *args):
+        return self.predicate.dispatch_key(*args)
+
+    def __call__(self, *args):
+        return self.predicate(*args)
+
+
+class LazyPredicate(object):
+    """ Stands in for a predicate whose factory was added with ``lazy``.
+
+    The predicate is only created (from ``factory(value, api)``) the first
+    time it is called, or asked for its text.  Its phash is computed at
+    registration without creating it.
+    """
+    __slots__ = ('factory', 'value', 'api', '_phash', '_predicate')
+
+    def __init__(self, factory, value, api, phash):
+        self.factory = factory
+        self.value = value
+        self.api = api
+        self._phash = phash
+        self._predicate = None
+
+    @property
+    def predicate(self):
+        predicate = self._predicate
+        if predicate is None:
+            predicate = self._predicate = self.factory(self.value, self.api)
+        return predicate
+
+    def text(self):
+        return self.predicate.text()
+
+    def phash(self):
+        return self._phash
+
+    def __call__(self, *args):
+        predicate = self._predicate
+        if predicate is None:
+            predicate = self.predicate
+        return predicate(*args)
+
+
+def _hashes(pred):
+    # the phash of a predicate as a tuple of hashes
+    hashes = pred.phash()
+    if is_nonstr_iter(hashes):
+        return tuple(hashes)
+    return (hashes,)
+
+
+def _keyable(pred, value):
+    if getattr(pred, 'dispatch_key', None) is None:
+        return False
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+class Blake2bPhash(object):
+    """ The default phash strategy of :class:`PredicateList`: the 128-bit
+    blake2b digest of the predicate hashes, as an integer.
+
+    ``default`` is the phash of an empty predicate list.
+    """
+    default = int.from_bytes(blake2b(digest_size=16).digest(), 'big')
+
+    def __call__(self, hashes):
+        phash = blake2b(digest_size=16)
+        for h in hashes:
+            phash.update(bytes_(h))
+        return int.from_bytes(phash.digest(), 'big')
+
+
+class MD5Phash(object):
+    """ A phash strategy returning the md5 hexdigest of the predicate
+    hashes, as computed by earlier releases, for callers which store
+    phashes.
+
+    ``default`` is the phash of an empty predicate list, ``DEFAULT_PHASH``.
+    """
+    default = DEFAULT_PHASH
+
+    def __call__(self, hashes):
+        phash = md5()
+        for h in hashes:
+            phash.update(bytes_(h))
+        return phash.hexdigest()
+
+
 class PredicateList(object):
     """Select from among a list of candidates using their predicates.
+
+    ``phash`` is a factory for the strategy computing the phash of a
+    predicate list from the hashes of its predicates, by default
+    :class:`Blake2bPhash`.  If ``keyed`` is true, predicates supporting
+    dispatch by key are wrapped in :class:`Keyed`.
     """
-    def __init__(self):
+    def __init__(self, phash=None, keyed=False):
+        if phash is None:
+            phash = Blake2bPhash
+        self.phasher = phash()
+        self.keyed = keyed
         self.sorter = TopologicalSorter()
         self.last_added = None
-
-    def add(self, name, factory, before=None, after=None):
+        self._table = None
+        self._table_version = None
+        self._interned = {}
+        self._lazy = {}
+        self._orders = {}
+
+    def _ordered(self):
+        # (name, factory, weight) for each predicate in sorted order, cached
+        # until the sorter changes.
+        if self._table_version != self.sorter.version:
+            self._table = [
+                (name, factory, 1 << n+1)
+                for n, (name, factory) in enumerate(self.sorter.sorted())
+            ]
+            self._table_version = self.sorter.version
+        return self._table
+
+    def add(self, name, factory, before=None, after=None, lazy=False):
         """ Add a predicate factory to a predicate list
 
         Predicates should be added in (presumed) computation expense order.
+
+        If ``lazy`` is true, the predicates are only created when they are
+        first called (see :class:`LazyPredicate`).  Their phash is then
+        ``'name = repr(value)'``, or ``lazy(value)`` if ``lazy`` is
+        callable.
         """
+        if lazy:
+            if not callable(lazy):
+                lazy = lambda value: '%s = %r' % (name, value)
+            self._lazy[name] = lazy
+        else:
+            self._lazy.pop(name, None)
         self.last_added = name
         self.sorter.add(
             name,
@@ -287,6 +767,29 @@ class PredicateList(object):
             before=after,
             )
 
+    def _intern(self, name, factory, pred, hashes):
+        # Share one instance between the candidates using the same predicate
+        # value.  Predicates with an empty phash can't be told apart, so
+        # they are never shared.
+        if not any(hashes):
+            return pred
+        key = (name, factory, pred.__class__, hashes)
+        try:
+            return self._interned.setdefault(key, pred)
+        except TypeError: # unhashable phash
+            return pred
+
+    def _create(self, name, factory, lazy, value, notted, api):
+        if lazy is not None:
+            pred = LazyPredicate(factory, value, api, lazy(value))
+        else:
+            pred = factory(value, api)
+        if notted:
+            pred = Notted(pred)
+        elif self.keyed and lazy is None and _keyable(pred, value):
+            pred = Keyed(pred, name, value)
+        return pred
+
     def make(self, api, **kw):
         """ Compute a predicate list given an api object and a list of keywords
 
@@ -302,34 +805,31 @@ class PredicateList(object):
 
         While we compute predicates, we also compute a predicate hash (aka
         phash) that can be used by a caller to identify identical predicate
-        lists.
+        lists.  Predicates of the same name and (non-empty) phash are
+        created once and shared by every list which uses them.
         """
-        ordered = self.sorter.sorted()
-        phash = md5()
+        hashes_seen = []
         weights = []
         preds = []
-        for n, (name, predicate_factory) in enumerate(ordered):
+        for name, predicate_factory, weight in self._ordered():
+            lazy = self._lazy.get(name)
             vals = kw.pop(name, None)
             if vals is None: # XXX should this be a sentinel other than None?
                 continue
             if not isinstance(vals, predvalseq):
                 vals = (vals,)
             for val in vals:
-                realval = val
-                notted = False
                 if isinstance(val, not_):
-                    realval = val.value
-                    notted = True
-                pred = predicate_factory(realval, api)
-                if notted:
-                    pred = Notted(pred)
-                hashes = pred.phash()
-                if not is_nonstr_iter(hashes):
-                    hashes = [hashes]
-                for h in hashes:
-                    phash.update(bytes_(h))
-                weights.append(1 << n+1)
-                preds.append(pred)
+                    pred = self._create(
+                        name, predicate_factory, lazy, val.value, True, api)
+                else:
+                    pred = self._create(
+                        name, predicate_factory, lazy, val, False, api)
+                hashes = _hashes(pred)
+                hashes_seen.extend(hashes)
+                weights.append(weight)
+                preds.append(
+                    self._intern(name, predicate_factory, pred, hashes))
         if kw:
             raise SortingError('Unknown predicate values: %r' % (kw,))
         # A "order" is computed for the predicate list.  An order is
@@ -341,9 +841,9 @@ class PredicateList(object):
         # greater importance.
         #
         # All weights for a given predicate list are bitwise ORed together
-        # to create a "score"; this score is then subtracted from
-        # MAX_ORDER and divided by an integer representing the number of
-        # predicates+1 to determine the order.
+        # to create a "score"; the order is the tuple of the negated number
+        # of predicates and the negated score.  Integers don't overflow, so
+        # any number of predicates can be weighted.
         #
         # For views, the order represents the ordering in which a "multiview"
         # ( a collection of views that share the same context/request/name
@@ -353,19 +853,92 @@ class PredicateList(object):
         # always evaluated before views with fewer predicates and b) to
         # ensure a stable call ordering of views that share the same number
         # of predicates.  Views which do not have any predicates get an order
-        # of MAX_ORDER, meaning that they will be tried very last.
+        # of (0, 0), meaning that they will be tried very last.
         score = 0
         for bit in weights:
             score = score | bit
-        order = (MAX_ORDER - score) / (len(preds) + 1)
-        return order, preds, phash.hexdigest()
+        order = (-len(preds), -score)
+        order = self._orders.setdefault(order, order)
+        return order, preds, self.phasher(hashes_seen)
+
+    def _restore_order(self, names):
+        # Use ``names`` as the sorted order of the predicates, skipping the
+        # topological sort.
+        name2val = self.sorter.name2val
+        self._table = [
+            (name, name2val[name], 1 << n+1) for n, name in enumerate(names)
+        ]
+        self._table_version = self.sorter.version
+
+    def _values(self, kw):
+        # The ``(name, notted, value)`` of each predicate value in ``kw``,
+        # in the order of the predicates ``make`` would create.
+        values = []
+        for name, predicate_factory, weight in self._ordered():
+            vals = kw.get(name)
+            if vals is None:
+                continue
+            if not isinstance(vals, predvalseq):
+                vals = (vals,)
+            for val in vals:
+                if isinstance(val, not_):
+                    values.append((name, True, val.value))
+                else:
+                    values.append((name, False, val))
+        return values
+
+    def _restore(self, api, values):
+        # One predicate for each ``[name, notted, value]`` of a snapshot,
+        # interned as by ``make``.
+        name2val = self.sorter.name2val
+        lazy = self._lazy
+        preds = []
+        for name, notted, value in values:
+            factory = name2val[name]
+            pred = self._create(
+                name, factory, lazy.get(name), value, notted, api)
+            preds.append(self._intern(name, factory, pred, _hashes(pred)))
+        return preds
 
 
 class PredicateDispatch(object):
+    """ The ordered candidates registered for one (required, provided,
+    name) triad.
+
+    ``matcher``, if given, is a factory called with the dispatch and the
+    ``by_phash`` mapping which returns a callable selecting the first
+    matching candidate for a set of arguments (or ``_marker``); see
+    :class:`TreeMatcher`.  It is rebuilt lazily after candidates are added.
+    """
 
-    def __init__(self, name):
+    __slots__ = ('name', 'matcher', '_matcher', '_state', '_orders',
+                 '_candidates', '_phashes', '_by_phash', '_lock')
+
+    def __init__(self, name, matcher=None):
         self.name = name
-        self.candidates = []
+        self.matcher = matcher
+        # Writers keep three parallel lists, in order: ``_orders`` (for
+        # bisection), ``_candidates`` and ``_phashes``; ``_by_phash`` maps
+        # each phash to the order of its entry.  Lookups read ``_state``, a
+        # snapshot of the lists as three tuples which is never modified.
+        # An ``add`` only discards it, and the next lookup takes a new one,
+        # so that registering N candidates one at a time copies nothing
+        # while nothing looks them up.  ``_lock`` is held while the lists
+        # change or are copied.  ``_matcher`` is a ``(state, by_phash,
+        # matcher)`` triple built for one snapshot.
+        self._orders = []
+        self._candidates = []
+        self._phashes = []
+        self._by_phash = {}
+        self._state = ((), (), ())
+        self._matcher = None
+        self._lock = threading.Lock()
+
+    @property
+    def candidates(self):
+        """ The ``(order, candidate, phash)`` entries, in order.
+        """
+        return list(self)
 
     def __discriminator__(self, *args):
         # used by introspection systems like so:
@@ -376,25 +949,596 @@ class PredicateDispatch(object):
         candidate = self.match(*args)
         return candidate.__discriminator__(*args)
 
+    def _index(self, order, phash):
+        phashes = self._phashes
+        i = bisect.bisect_left(self._orders, order)
+        while phashes[i] != phash:
+            i += 1
+        return i
+
     def add(self, candidate, order, phash=None):
-        if phash is not None:
-            for i, (s, v, h) in enumerate(list(self.candidates)):
-                if phash == h:
-                    self.candidates[i] = (order, candidate, phash)
-                    return
-        self.candidates.append((order, candidate, phash))
-        self.candidates.sort(key=operator.itemgetter(0))
+        """ Add a candidate, or replace the candidate with the same phash.
+
+        Each call costs time linear in the number of candidates (a list
+        insertion); use :meth:`add_many` to add many at once.  Lookups may
+        run concurrently.
+        """
+        with self._lock:
+            self._state = None
+            self._matcher = None
+            if phash is not None:
+                existing = self._by_phash.get(phash)
+                self._by_phash[phash] = order
+                if existing is not None:
+                    i = self._index(existing, phash)
+                    if existing == order:
+                        self._candidates[i] = candidate
+                        return
+                    del self._orders[i]
+                    del self._candidates[i]
+                    del self._phashes[i]
+            # after any candidates of equal order, as a stable sort would
+            i = bisect.bisect_right(self._orders, order)
+            self._orders.insert(i, order)
+            self._candidates.insert(i, candidate)
+            self._phashes.insert(i, phash)
+
+    def add_many(self, entries):
+        """ Add several ``(candidate, order, phash)`` entries, sorting the
+        candidates only once.
+        """
+        with self._lock:
+            self._state = None
+            self._matcher = None
+            candidates = list(zip(
+                self._orders, self._candidates, self._phashes))
+            positions = dict(
+                (h, i) for i, h in enumerate(self._phashes) if h is not None
+            )
+            for candidate, order, phash in entries:
+                if phash is not None:
+                    i = positions.get(phash)
+                    if i is not None:
+                        candidates[i] = (order, candidate, phash)
+                        continue
+                    positions[phash] = len(candidates)
+                candidates.append((order, candidate, phash))
+            candidates.sort(key=operator.itemgetter(0))
+            self._orders = [order for order, _, _ in candidates]
+            self._candidates = [candidate for _, candidate, _ in candidates]
+            self._phashes = [phash for _, _, phash in candidates]
+            self._by_phash = dict(
+                (phash, order) for order, _, phash in candidates
+                if phash is not None
+            )
+
+    def _snapshot(self):
+        # the current ``_state``, taking a new one after an ``add``
+        state = self._state
+        if state is None:
+            with self._lock:
+                state = self._state
+                if state is None:
+                    state = self._state = (tuple(self._orders),
+                                           tuple(self._candidates),
+                                           tuple(self._phashes))
+        return state
 
     def __iter__(self):
-        return iter(self.candidates)
+        return zip(*self._snapshot())
 
     def match(self, by_phash, *args):
-        for order, candidate, phash in self:
+        candidate = self._select(by_phash, args)
+        if candidate is _marker:
+            raise PredicateMismatch(self.name)
+        return candidate
+
+    def compile(self, by_phash):
+        """ Generate a specialized match function for the current candidates
+        (see :func:`compile_matcher`) and use it for lookups against
+        ``by_phash`` until the next :meth:`add`.
+        """
+        state = self._snapshot()
+        self._matcher = (state, by_phash, compile_matcher(self, by_phash))
+
+    def _current_matcher(self, by_phash):
+        # the matcher built for the current candidates and ``by_phash``, if
+        # any.  A matcher built while an ``add`` runs may have seen the
+        # newer candidates, but it is recorded with the older snapshot and
+        # so never used for the wrong candidates.
+        state = self._snapshot()
+        built = self._matcher
+        if built is not None and built[0] is state and built[1] is by_phash:
+            return built[2]
+        if self.matcher is not None:
+            matcher = self.matcher(self, by_phash)
+            self._matcher = (state, by_phash, matcher)
+            return matcher
+        return None
+
+    def _select(self, by_phash, args):
+        matcher = self._current_matcher(by_phash)
+        if matcher is None:
+            return self._scan(by_phash, args)
+        return matcher(*args)
+
+    def _scan(self, by_phash, args):
+        _, candidates, phashes = self._snapshot()
+        for candidate, phash in zip(candidates, phashes):
+            if phash is None:
+                return candidate
+            for pred in by_phash[phash]:
+                if not pred(*args):
+                    break
+            else:
+                return candidate
+        return _marker
+
+
+class FrozenDispatch(object):
+    """ A read-only copy of a :class:`PredicateDispatch`, used by a frozen
+    :class:`PredicateDomain`.
+
+    ``entries`` is a tuple of ``(candidate, predicates)`` pairs in order,
+    with each candidate's predicates resolved from ``by_phash`` into a
+    tuple.  The dispatch's matcher, if any, is built once.
+    """
+    __slots__ = ('name', 'entries', '_matcher')
+
+    def __init__(self, dispatch, by_phash):
+        self.name = dispatch.name
+        self.entries = tuple([
+            (candidate, tuple(by_phash[phash]) if phash is not None else ())
+            for order, candidate, phash in dispatch
+        ])
+        self._matcher = dispatch._current_matcher(by_phash)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def select(self, *args):
+        """ Return the first matching candidate, or ``_marker``.
+        """
+        if self._matcher is not None:
+            return self._matcher(*args)
+        for candidate, preds in self.entries:
+            for pred in preds:
+                if not pred(*args):
+                    break
+            else:
+                return candidate
+        return _marker
+
+    def match(self, *args):
+        candidate = self.select(*args)
+        if candidate is _marker:
+            raise PredicateMismatch(self.name)
+        return candidate
+
+
+class PackedDispatch(object):
+    """ A read-only copy of a :class:`PredicateDispatch` packed into a single
+    flat tuple, used by a domain frozen with ``pack=True``.
+
+    ``packed`` holds, for each candidate in order, the candidate, the number
+    of its predicates and then the predicates themselves, so selecting a
+    candidate touches one tuple instead of a pair and a predicate tuple per
+    candidate.  This keeps the pages written to by reference counting in a
+    forked worker to a minimum.
+    """
+    __slots__ = ('name', 'packed', '_matcher')
+
+    def __init__(self, dispatch, by_phash):
+        self.name = dispatch.name
+        packed = []
+        for order, candidate, phash in dispatch:
+            preds = by_phash[phash] if phash is not None else ()
+            packed.append(candidate)
+            packed.append(len(preds))
+            packed.extend(preds)
+        self.packed = tuple(packed)
+        self._matcher = dispatch._current_matcher(by_phash)
+
+    def __iter__(self):
+        packed = self.packed
+        i = 0
+        while i < len(packed):
+            start = i + 2
+            end = start + packed[i + 1]
+            yield packed[i], packed[start:end]
+            i = end
+
+    def select(self, *args):
+        """ Return the first matching candidate, or ``_marker``.
+        """
+        if self._matcher is not None:
+            return self._matcher(*args)
+        packed = self.packed
+        size = len(packed)
+        i = 0
+        while i < size:
+            j = i + 2
+            end = j + packed[i + 1]
+            while j < end:
+                if not packed[j](*args):
+                    break
+                j += 1
+            else:
+                return packed[i]
+            i = end
+        return _marker
+
+    def match(self, *args):
+        candidate = self.select(*args)
+        if candidate is _marker:
+            raise PredicateMismatch(self.name)
+        return candidate
+
+
+def _predicate_key(pred):
+    # Predicates with the same type and phash are taken to be equivalent, so
+    # one evaluation per lookup can stand for all of them.  A predicate
+    # without a phash is only "pretending" (see ``Notted``) and is never
+    # shared.
+    phash = getattr(pred, 'phash', None)
+    if phash is None:
+        return None
+    hashes = phash()
+    if not hashes:
+        return None
+    if is_nonstr_iter(hashes):
+        hashes = tuple(hashes)
+    if isinstance(pred, (Notted, Keyed)):
+        return (pred.__class__, pred.predicate.__class__, hashes)
+    return (pred.__class__, hashes)
+
+
+class TreeMatcher(object):
+    """ A :class:`PredicateDispatch` matcher which evaluates each distinct
+    predicate at most once per lookup.
+
+    Predicates are interned by type and phash, and runs of consecutive
+    candidates whose predicate lists start with the same predicate are
+    grouped under a single test of it, recursively, forming a decision tree
+    which is walked in candidate order.  The candidate selected is always
+    the one the plain ordered scan would select, provided that equal
+    predicates give equal answers for the same arguments.
+    """
+    def __init__(self, dispatch, by_phash):
+        self.predicates = []
+        slots = {}
+        entries = []
+        for order, candidate, phash in dispatch:
+            path = []
+            if phash is not None:
+                for pred in by_phash[phash]:
+                    key = _predicate_key(pred)
+                    slot = slots.get(key) if key is not None else None
+                    if slot is None:
+                        slot = len(self.predicates)
+                        self.predicates.append(pred)
+                        if key is not None:
+                            slots[key] = slot
+                    path.append(slot)
+            entries.append((candidate, tuple(path)))
+        self.tree = self._build(entries)
+
+    def _build(self, entries):
+        # -> [(slot, subtree), ...] with ``(None, candidate)`` leaves
+        nodes = []
+        i, count = 0, len(entries)
+        while i < count:
+            candidate, path = entries[i]
+            if not path:
+                nodes.append((None, candidate))
+                i += 1
+                continue
+            slot = path[0]
+            j = i + 1
+            while j < count and entries[j][1][:1] == (slot,):
+                j += 1
+            nodes.append(
+                (slot, self._build([(c, p[1:]) for c, p in entries[i:j]])))
+            i = j
+        return nodes
+
+    def __call__(self, *args):
+        results = [None] * len(self.predicates)
+        return self._walk(self.tree, results, args)
+
+    def _walk(self, nodes, results, args):
+        for slot, child in nodes:
+            if slot is None:
+                return child
+            result = results[slot]
+            if result is None:
+                result = results[slot] = bool(self.predicates[slot](*args))
+            if result:
+                found = self._walk(child, results, args)
+                if found is not _marker:
+                    return found
+        return _marker
+
+
+class BitmaskMatcher(object):
+    """ A :class:`PredicateDispatch` matcher working on integer bitmasks.
+
+    Each distinct predicate (interned by type and phash) is assigned a bit,
+    and each candidate's predicate list, computed once per phash, becomes a
+    mask of required bits.  A lookup lazily evaluates predicates into
+    ``known`` and ``true`` masks, so a candidate needing a predicate already
+    known to be false is rejected with integer operations alone.  The
+    candidate selected is the one the plain ordered scan would select.
+    """
+    def __init__(self, dispatch, by_phash):
+        self.predicates = []
+        bits = {}
+        compiled = {}
+        entries = []
+        for order, candidate, phash in dispatch:
             if phash is None:
+                entries.append((candidate, 0, ()))
+                continue
+            tests = compiled.get(phash)
+            if tests is None:
+                mask = 0
+                tests = []
+                for pred in by_phash[phash]:
+                    key = _predicate_key(pred)
+                    bit = bits.get(key) if key is not None else None
+                    if bit is None:
+                        bit = 1 << len(self.predicates)
+                        self.predicates.append(pred)
+                        if key is not None:
+                            bits[key] = bit
+                    if not mask & bit:
+                        mask |= bit
+                        tests.append((bit, pred))
+                tests = compiled[phash] = (mask, tuple(tests))
+            entries.append((candidate,) + tests)
+        self.entries = tuple(entries)
+
+    def __call__(self, *args):
+        known = true = 0
+        for candidate, mask, tests in self.entries:
+            if mask & known & ~true:
+                # a required predicate is already known to be false
+                continue
+            if mask & ~known:
+                for bit, pred in tests:
+                    if not known & bit:
+                        known |= bit
+                        if pred(*args):
+                            true |= bit
+                        else:
+                            break
+                else:
+                    return candidate
+                continue
+            return candidate
+        return _marker
+
+
+class KeyedMatcher(object):
+    """ A :class:`PredicateDispatch` matcher which indexes candidates by the
+    value of a :class:`Keyed` predicate.
+
+    The predicate name used by the most candidates is chosen as the key.
+    A lookup computes its ``dispatch_key`` once and only scans the
+    candidates registered for that value, plus those without a predicate
+    of that name, in their usual order; the keyed predicate itself is not
+    called again.  Other predicates, including negated ones, are evaluated
+    as by the plain ordered scan, which is also used when the key computed
+    for a lookup is unhashable.
+
+    A :class:`PredicateDomain` only creates :class:`Keyed` predicates when
+    its ``matcher`` has a true ``keyed`` attribute, as this class does.
+    """
+    keyed = True
+
+    def __init__(self, dispatch, by_phash):
+        entries = []
+        counts = {}
+        for order, candidate, phash in dispatch:
+            preds = tuple(by_phash[phash]) if phash is not None else ()
+            keyed = {}
+            for pred in preds:
+                if isinstance(pred, Keyed) and pred.name not in keyed:
+                    keyed[pred.name] = pred
+                    counts[pred.name] = counts.get(pred.name, 0) + 1
+            entries.append((candidate, preds, keyed))
+        self.entries = tuple([(c, preds) for c, preds, _ in entries])
+        self.key_predicate = None
+        self.index = {}
+        self.fallback = self.entries
+        if not counts:
+            return
+        name = max(counts, key=counts.get)
+        index = {}
+        fallback = []
+        for candidate, preds, keyed in entries:
+            pred = keyed.get(name)
+            if pred is None:
+                fallback.append((candidate, preds))
+                for subset in index.values():
+                    subset.append((candidate, preds))
+                continue
+            if self.key_predicate is None:
+                self.key_predicate = pred
+            if pred.value not in index:
+                index[pred.value] = list(fallback)
+            i = preds.index(pred)
+            index[pred.value].append((candidate, preds[:i] + preds[i+1:]))
+        self.index = dict((k, tuple(v)) for k, v in index.items())
+        self.fallback = tuple(fallback)
+
+    def __call__(self, *args):
+        entries = self.fallback
+        if self.key_predicate is not None:
+            try:
+                entries = self.index.get(
+                    self.key_predicate.dispatch_key(*args), entries)
+            except TypeError: # unhashable key
+                entries = self.entries
+        for candidate, preds in entries:
+            for pred in preds:
+                if not pred(*args):
+                    break
+            else:
                 return candidate
-            if all((pred(*args) for pred in by_phash[phash])):
+        return _marker
+
+
+class AdaptiveMatcher(object):
+    """ A :class:`PredicateDispatch` matcher which learns in which order to
+    evaluate each candidate's predicates.
+
+    A candidate is selected only if all of its predicates are true, so they
+    may be evaluated in any order.  One lookup in ``sample`` records, per
+    predicate (interned by type and phash), the number of calls, the time
+    they take and how many return false; it calls the same predicates as
+    the plain ordered scan.  Every ``interval`` sampled lookups,
+    :meth:`reorder` sorts each candidate's predicates by their mean cost
+    divided by their rejection rate, so that those most likely to reject a
+    candidate for the least time come first.  Other lookups are plain
+    ordered scans.  The candidate selected is the one the plain ordered
+    scan would select, provided that predicates have no side effects.  Pass
+    ``functools.partial`` of the class to change ``sample`` or
+    ``interval``.
+    """
+    def __init__(self, dispatch, by_phash, sample=64, interval=16):
+        self.sample = sample
+        self.interval = interval
+        self.predicates = []
+        slots = {}
+        entries = []
+        for order, candidate, phash in dispatch:
+            preds = tuple(by_phash[phash]) if phash is not None else ()
+            path = []
+            for pred in preds:
+                key = _predicate_key(pred)
+                slot = slots.get(key) if key is not None else None
+                if slot is None:
+                    slot = len(self.predicates)
+                    self.predicates.append(pred)
+                    if key is not None:
+                        slots[key] = slot
+                path.append(slot)
+            entries.append((candidate, preds, tuple(path)))
+        # ``entries`` is replaced, never modified, by ``reorder``
+        self.entries = tuple(entries)
+        count = len(self.predicates)
+        self.calls = [0.0] * count
+        self.rejections = [0.0] * count
+        self.costs = [0.0] * count
+        self._lookups = 0
+        self._samples = 0
+
+    def __call__(self, *args):
+        self._lookups += 1
+        if self._lookups >= self.sample:
+            return self._sampled(args)
+        for candidate, preds, slots in self.entries:
+            for pred in preds:
+                if not pred(*args):
+                    break
+            else:
                 return candidate
-        raise PredicateMismatch(self.name)
+        return _marker
+
+    def _sampled(self, args):
+        self._lookups = 0
+        clock = time.perf_counter
+        calls = self.calls
+        rejections = self.rejections
+        costs = self.costs
+        found = _marker
+        for candidate, preds, slots in self.entries:
+            for slot, pred in zip(slots, preds):
+                start = clock()
+                result = pred(*args)
+                costs[slot] += clock() - start
+                calls[slot] += 1
+                if not result:
+                    rejections[slot] += 1
+                    break
+            else:
+                found = candidate
+                break
+        self._samples += 1
+        if self._samples >= self.interval:
+            self.reorder()
+        return found
+
+    def reorder(self):
+        """ Sort each candidate's predicates by their mean cost per call
+        divided by their rejections per call, as sampled so far, then halve
+        the statistics so that recent lookups weigh more.  Predicates which
+        never rejected a candidate come last, in their previous order.
+        """
+        self._samples = 0
+        inf = float('inf')
+        scores = [
+            (cost / calls) / (rejected / calls) if rejected else inf
+            for calls, cost, rejected in zip(
+                self.calls, self.costs, self.rejections)
+        ]
+        entries = []
+        for candidate, preds, slots in self.entries:
+            tests = sorted(zip(slots, preds), key=lambda t: scores[t[0]])
+            entries.append((candidate,
+                            tuple([pred for slot, pred in tests]),
+                            tuple([slot for slot, pred in tests])))
+        self.entries = tuple(entries)
+        for stats in (self.calls, self.rejections, self.costs):
+            stats[:] = [value / 2 for value in stats]
+
+
+def compile_matcher(dispatch, by_phash):
+    """ A :class:`PredicateDispatch` matcher factory which generates
+    straight-line Python source for the ordered scan and executes it.
+
+    Candidates and predicates are bound as globals of the function, and the
+    ``Notted`` / ``Keyed`` wrappers are unwrapped with any negation inlined
+    as ``not``.  The generated function is returned directly; its source is
+    available as its ``source`` attribute.
+    """
+    names = []
+    values = []
+    body = []
+    for i, (order, candidate, phash) in enumerate(dispatch):
+        names.append('c%d' % i)
+        values.append(candidate)
+        tests = []
+        if phash is not None:
+            for j, pred in enumerate(by_phash[phash]):
+                test = '%s(*args)'
+                if isinstance(pred, Notted):
+                    if pred.phash():
+                        test = 'not %s(*args)'
+                    pred = pred.predicate
+                elif isinstance(pred, Keyed):
+                    pred = pred.predicate
+                names.append('p%d_%d' % (i, j))
+                values.append(pred)
+                tests.append(test % names[-1])
+        if not tests:
+            body.append('    return c%d' % i)
+            break
+        body.append('    if %s:' % ' and '.join(tests))
+        body.append('        return c%d' % i)
+    else:
+        body.append('    return _marker')
+    source = '\n'.join(['def match(*args):'] + body + [''])
+    # bound as globals of the generated function: compiling thousands of
+    # closure variables takes time quadratic in their number
+    namespace = dict(zip(names, values))
+    namespace['_marker'] = _marker
+    exec(compile(source, '<walkabout %r>' % (dispatch.name,), 'exec'),
+         namespace)
+    match = namespace['match']
+    match.source = source
+    return match
 
 
 class IPredicateDomain(Interface):
@@ -404,36 +1548,101 @@ class IPredicateDomain(Interface):
     target_interface = Attribute(
         "The target interface to which the candidate adapters conform.")
 
-    def add_predicate(name, factory, before=None, after=None):
+    def add_predicate(name, factory, before=None, after=None, lazy=False):
         """ Register a new predicate by name.
+
+        If 'lazy' is true, predicates are only created when first called.
         """
 
     def add_candidate(candidate, *args, **kw):
         """ Register one adapter candidate for a given set of interfaces.
         """
 
+    def add_candidates(registrations):
+        """ Register several candidates in one pass.
+
+        'registrations' is an iterable of '(candidate, args, kw)' tuples, each
+        holding the arguments of one 'add_candidate' call.
+        """
+
+    def batch():
+        """ Context manager buffering 'add_candidate' calls until it exits.
+        """
+
     def lookup(*args, **kw):
         """ Find the "best" matching candidate for 'args'
 
         Pass 'name' as a keyword argument.
         """
 
+    def lookup_for_specs(specs, *args, **kw):
+        """ Like 'lookup', for callers already holding the specifications
+        provided by 'args' ('specs').
+        """
+
+    def query(*args, **kw):
+        """ Like 'lookup', but return 'default' rather than raising when no
+        candidate matches.
+
+        Pass 'name' and 'default' as keyword arguments.
+        """
+
     def all(*args):
         """ -> [(name, factory)] for factories dispatched against 'args'.
         """
 
+    def snapshot(fingerprint):
+        """ -> the computed state of the candidates added so far.
+
+        'fingerprint' identifies the configuration which added them.
+        """
+
+    def restore(snapshot, fingerprint):
+        """ Add the candidates of a snapshot taken with 'fingerprint'.
+
+        Returns False, adding nothing, if the snapshot does not apply.
+        """
+
+    def freeze(pack=False):
+        """ Make the domain read-only, and its lookups faster.
+
+        Adding predicates or candidates afterwards raises FrozenDomainError.
+        If 'pack' is true, each dispatch is packed into a single tuple.
+        """
+
 
 @implementer(IPredicateDomain)
 class PredicateDomain(object):
 
-    def __init__(self, target_interface, registry):
+    def __init__(self, target_interface, registry, matcher=None, index=None,
+                 phash=None, record=False):
         self.target_interface = target_interface
         self.registry = registry
-        self.predicates = PredicateList()
+        self.matcher = matcher
+        if index is None:
+            index = RegistryIndex
+        self.index = index(registry, target_interface)
+        self.predicates = PredicateList(
+            phash, keyed=getattr(matcher, 'keyed', False))
         self.by_phash = {}
-
-    def add_predicate(self, name, factory, before=None, after=None):
-        return self.predicates.add(name, factory, before, after)
+        self._pending = None
+        self._class_specs = {}
+        self._dispatches = []
+        self._frozen = None
+        self._frozen_factory = FrozenDispatch
+        self._lock = threading.Lock()
+        # ``(candidate, args, name, kw, order, phash)`` for each candidate
+        # registered, if recording for ``snapshot``
+        self._records = [] if record else None
+
+    def _check_frozen(self):
+        if self._frozen is not None:
+            raise FrozenDomainError('The predicate domain is frozen')
+
+    def add_predicate(self, name, factory, before=None, after=None,
+                      lazy=False):
+        self._check_frozen()
+        return self.predicates.add(name, factory, before, after, lazy)
 
     def _verifyArgs(self, args, kw):
         if len(args) == 0:
@@ -441,7 +1650,11 @@ class PredicateDomain(object):
         return kw.pop('name', '')
 
     def add_candidate(self, candidate, *args, **kw):
+        self._check_frozen()
         name = self._verifyArgs(args, kw)
+        record = None
+        if self._records is not None:
+            record = (candidate, args, name, dict(kw))
         args = list(args)
         for i, arg in enumerate(args):
             if not IInterface.providedBy(arg):
@@ -449,34 +1662,581 @@ class PredicateDomain(object):
                     args[i] = implementedBy(arg)
                 else:
                     raise ValueError('Must provide dispatch args as interfaces')
-        adapters = self.registry.adapters
-        dispatch = adapters.lookup(args, self.target_interface,
-                                                name=name, default=None)
-        if dispatch is None:
-            dispatch = PredicateDispatch(name)
-            adapters.register(args, self.target_interface, name, dispatch)
         order, preds, phash = self.predicates.make(self.registry, **kw)
-        dispatch.add(candidate, order, phash)
-        self.by_phash[phash] = preds
+        registration = (
+            tuple(args), name, candidate, order, preds, phash, record)
+        if self._pending is not None:
+            self._pending.append(registration)
+        else:
+            self._register([registration])
+
+    def add_candidates(self, registrations):
+        self._check_frozen()
+        with self.batch():
+            for candidate, args, kw in registrations:
+                self.add_candidate(candidate, *args, **kw)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """ Buffer the candidates added within the ``with`` block and register
+        them when it exits: one adapter lookup / registration per set of
+        interfaces and name, and one sort per dispatch.  Nothing is
+        registered if the block raises.  Nested batches join the outermost
+        one.
+        """
+        self._check_frozen()
+        if self._pending is not None:
+            yield self
+            return
+        self._pending = []
+        try:
+            yield self
+            pending = self._pending
+        finally:
+            self._pending = None
+        self._register(pending)
+
+    def _register(self, registrations):
+        # Lookups don't lock: each predicate list is in ``by_phash`` before
+        # a dispatch publishes a candidate using it.  Registrations are
+        # serialized.
+        with self._lock:
+            self._register_locked(registrations)
+
+    def _register_locked(self, registrations):
+        index = self.index
+        dispatches = {}
+        groups = {}
+        for registration in registrations:
+            args, name, candidate, order, preds, phash, record = registration
+            if record is not None:
+                self._records.append(record + (order, phash))
+            dispatch = dispatches.get((args, name))
+            if dispatch is None:
+                dispatch = index.find(args, name)
+                if dispatch is None:
+                    dispatch = PredicateDispatch(name, self.matcher)
+                    index.register(args, name, dispatch)
+                    self._dispatches.append(dispatch)
+                dispatches[(args, name)] = dispatch
+            groups.setdefault(dispatch, []).append((candidate, order, phash))
+            self.by_phash[phash] = tuple(preds)
+        for dispatch, entries in groups.items():
+            if len(entries) == 1:
+                dispatch.add(*entries[0])
+            else:
+                dispatch.add_many(entries)
+
+    def _provided(self, ob):
+        """ Return ``providedBy(ob)``, looking it up by class for instances
+        whose provided interfaces are those implemented by their class.
+        """
+        spec = self._class_specs.get(type(ob))
+        if spec is None:
+            spec = self._class_specs[type(ob)] = _class_spec(type(ob))
+        if spec is not False:
+            try:
+                if '__provides__' not in ob.__dict__:
+                    return spec
+            except AttributeError:
+                return spec
+        return providedBy(ob)
+
+    def _specs(self, args):
+        provided = self._provided
+        if len(args) == 1:
+            return (provided(args[0]),)
+        if len(args) == 2:
+            return (provided(args[0]), provided(args[1]))
+        return tuple([provided(x) for x in args])
 
     def lookup(self, *args, **kw):
         name = self._verifyArgs(args, kw)
         if kw:
             raise TypeError('Unknown keyword args: %s' % kw)
-        for_ = [providedBy(x) for x in args]
-        dispatch = self.registry.adapters.lookup(for_, self.target_interface,
-                                                 name=name)
+        dispatch = self.index.lookup(self._specs(args), name)
+        if dispatch is None:
+            raise PredicateMismatch()
+        frozen = self._frozen
+        if frozen is not None:
+            dispatch = frozen.get(dispatch) or self._freeze(dispatch)
+            return dispatch.match(*args)
+
+        return dispatch.match(self.by_phash, *args)
+
+    def lookup_for_specs(self, specs, *args, **kw):
+        name = self._verifyArgs(args, kw)
+        if kw:
+            raise TypeError('Unknown keyword args: %s' % kw)
+        dispatch = self.index.lookup(tuple(specs), name)
         if dispatch is None:
             raise PredicateMismatch()
+        frozen = self._frozen
+        if frozen is not None:
+            dispatch = frozen.get(dispatch) or self._freeze(dispatch)
+            return dispatch.match(*args)
 
         return dispatch.match(self.by_phash, *args)
 
+    def query(self, *args, **kw):
+        default = kw.pop('default', None)
+        name = self._verifyArgs(args, kw)
+        if kw:
+            raise TypeError('Unknown keyword args: %s' % kw)
+        specs = self._specs(args)
+        dispatch = self.index.lookup(specs, name)
+        if dispatch is None:
+            return default
+        frozen = self._frozen
+        if frozen is not None:
+            dispatch = frozen.get(dispatch) or self._freeze(dispatch)
+            candidate = dispatch.select(*args)
+        else:
+            candidate = dispatch._select(self.by_phash, args)
+        if candidate is _marker:
+            return default
+        return candidate
+
     def all(self, *args):
+        specs = self._specs(args)
+        frozen = self._frozen
+        if frozen is not None:
+            for name, dispatch in self.index.lookup_all(specs):
+                dispatch = frozen.get(dispatch) or self._freeze(dispatch)
+                factory = dispatch.select(*args)
+                if factory is not _marker:
+                    yield name, factory
+            return
+        by_phash = self.by_phash
+        for name, dispatch in self.index.lookup_all(specs):
+            factory = dispatch._select(by_phash, args)
+            if factory is not _marker:
+                yield name, factory
+
+    def freeze(self, pack=False):
+        """ Make the domain read-only once it is configured.
+
+        Lookups then go through a :class:`FrozenDispatch` copy of each
+        dispatch, or a :class:`PackedDispatch` one if ``pack`` is true, and
+        ``add_predicate`` and ``add_candidate`` raise
+        :class:`FrozenDomainError`.  Freezing a frozen domain does nothing.
+        """
+        if self._frozen is not None:
+            return
+        if self._pending is not None:
+            raise FrozenDomainError('Cannot freeze a domain within a batch')
+        self._frozen_factory = PackedDispatch if pack else FrozenDispatch
+        self._frozen = {}
+        for dispatch in self._dispatches:
+            self._freeze(dispatch)
+
+    def _freeze(self, dispatch):
+        # also used for dispatches registered by another domain for the
+        # same target interface
+        frozen = self._frozen[dispatch] = self._frozen_factory(
+            dispatch, self.by_phash)
+        return frozen
+
+    def snapshot(self, fingerprint):
+        """ Return the computed state of the candidates added so far, to be
+        passed to :meth:`restore` on the next start, e.g. through
+        :func:`json.dump`.
+
+        The domain must have been created with ``record=True``.  The
+        candidates, the interfaces or classes they are registered for and
+        the predicate factories are stored as importable dotted names, and
+        the predicate values, orders and phashes as they are, so they must
+        all survive a JSON round trip (use :class:`MD5Phash` or the default
+        :class:`Blake2bPhash`); a ``ValueError`` is raised otherwise.
+        ``fingerprint`` is any JSON value identifying the configuration
+        which added them (e.g. a digest of the configuration files and
+        package versions).
+        """
+        if self._records is None:
+            raise ValueError('The domain does not record its candidates')
+        predicates = self.predicates
+        # candidates, interfaces, predicate values and predicate lists are
+        # stored once each, and referred to by their index
+        objects = {}
+        values = {}
+        lists = {}
+        candidates = []
+        for candidate, args, name, kw, order, phash in self._records:
+            entry = lists.get(phash)
+            if entry is None:
+                indexes = []
+                for value in predicates._values(kw):
+                    key = json.dumps(_jsonable(list(value)), sort_keys=True)
+                    indexes.append(values.setdefault(key, len(values)))
+                entry = lists[phash] = (
+                    len(lists), [_jsonable(phash), list(order), indexes])
+            candidates.append([
+                _index(objects, candidate),
+                [_index(objects, arg) for arg in args],
+                name,
+                entry[0],
+            ])
+        return {
+            'version': 1,
+            'fingerprint': fingerprint,
+            'phash': _dotted(type(predicates.phasher)),
+            'predicates': [
+                [name, _dotted(factory)]
+                for name, factory, weight in predicates._ordered()
+            ],
+            'objects': [_dotted(ob) for ob in objects],
+            'values': [json.loads(key) for key in values],
+            'lists': [entry for index, entry in lists.values()],
+            'candidates': candidates,
+        }
+
+    def restore(self, snapshot, fingerprint):
+        """ Add the candidates of a :meth:`snapshot` without sorting the
+        predicates or computing their phashes and orders again.
+
+        The predicates must have been added already.  Returns ``False``,
+        adding nothing, if ``snapshot`` was taken with another
+        ``fingerprint``, phash strategy or set of predicates, in which case
+        the caller should add its candidates as usual; returns ``True``
+        otherwise.
+        """
+        self._check_frozen()
+        predicates = self.predicates
+        name2val = predicates.sorter.name2val
+        if (snapshot.get('version') != 1 or
+                snapshot.get('fingerprint') != fingerprint or
+                snapshot.get('phash') != _name(type(predicates.phasher)) or
+                dict(snapshot['predicates']) != dict(
+                    (name, _name(factory))
+                    for name, factory in name2val.items())):
+            return False
+        predicates._restore_order(
+            [name for name, factory in snapshot['predicates']])
+        resolved = {}
+        objects = [
+            _resolve(dotted, resolved) for dotted in snapshot['objects']
+        ]
+        # only for the objects candidates are registered for: calling
+        # ``implementedBy`` on a candidate would declare it
+        specs = {}
+        preds = predicates._restore(self.registry, snapshot['values'])
+        orders = predicates._orders
+        lists = []
+        for phash, order, indexes in snapshot['lists']:
+            order = tuple(order)
+            order = orders.setdefault(order, order)
+            lists.append(
+                (phash, order, tuple([preds[i] for i in indexes])))
+        recording = self._records is not None
+        registrations = []
+        for candidate, args, name, index in snapshot['candidates']:
+            phash, order, list_preds = lists[index]
+            record = None
+            if recording:
+                record = (objects[candidate],
+                          tuple([objects[arg] for arg in args]),
+                          name,
+                          _kw(snapshot['values'], snapshot['lists'][index][2]))
+            for arg in args:
+                if arg not in specs:
+                    ob = objects[arg]
+                    specs[arg] = (ob if IInterface.providedBy(ob)
+                                  else implementedBy(ob))
+            registrations.append((
+                tuple([specs[arg] for arg in args]),
+                name,
+                objects[candidate],
+                order,
+                list_preds,
+                phash,
+                record,
+            ))
+        if self._pending is not None:
+            self._pending.extend(registrations)
+        else:
+            self._register(registrations)
+        return True
+
+
+def prefork(*domains):
+    """ Prepare ``domains`` to be shared by forked worker processes.
+
+    Freezes each domain with ``pack=True``, then moves every object tracked
+    by the garbage collector into its permanent generation
+    (:func:`gc.freeze`), so that collections in the workers do not write to
+    the pages holding them.  Call it in the parent process right before
+    forking, after any lookups used to warm the caches; ideally also call
+    :func:`gc.disable` early in the parent and :func:`gc.enable` in each
+    worker.  Domains already frozen are left as they are.
+    """
+    for domain in domains:
+        domain.freeze(pack=True)
+    # gc.freeze is not available on PyPy
+    getattr(gc, 'freeze', lambda: None)()
+
+
+def _name(ob):
+    return '%s:%s' % (ob.__module__,
+                      getattr(ob, '__qualname__', None) or ob.__name__)
+
+
+def _dotted(ob):
+    # the importable dotted name of a module global or of a class attribute
+    try:
+        dotted = _name(ob)
+        found = _resolve(dotted, {})
+    except (AttributeError, ImportError):
+        found = None
+    if found is not ob:
+        raise ValueError('%r has no importable dotted name' % (ob,))
+    return dotted
+
+
+def _resolve(dotted, resolved):
+    ob = resolved.get(dotted, _marker)
+    if ob is _marker:
+        module, qualname = dotted.split(':')
+        ob = importlib.import_module(module)
+        for attr in qualname.split('.'):
+            ob = getattr(ob, attr)
+        resolved[dotted] = ob
+    return ob
+
+
+def _index(indexes, ob):
+    index = indexes.get(ob)
+    if index is None:
+        index = indexes[ob] = len(indexes)
+    return index
+
+
+def _kw(values, indexes):
+    # the predicate keyword arguments of a snapshot's predicate list
+    kw = {}
+    for i in indexes:
+        name, notted, value = values[i]
+        kw.setdefault(name, []).append(not_(value) if notted else value)
+    return dict((name, predvalseq(vals)) for name, vals in kw.items())
+
+
+def _jsonable(value):
+    try:
+        same = json.loads(json.dumps(value)) == value
+    except TypeError:
+        same = False
+    if not same:
+        raise ValueError('%r does not survive a JSON round trip' % (value,))
+    return value
+
+
+def _class_spec(cls):
+    """ Return ``implementedBy(cls)`` if that is what ``providedBy`` returns
+    for every instance of 'cls' without directly provided interfaces (an
+    ``__provides__`` in its ``__dict__``), else False.
+    """
+    if issubclass(cls, type):
+        # classes provide their class declarations
+        return False
+    if (cls.__getattribute__ is not object.__getattribute__
+            or inspect.getattr_static(cls, '__getattr__', None) is not None
+            or inspect.getattr_static(cls, '__class__')
+                is not object.__dict__['__class__']):
+        # proxies and the like can answer for another object
+        return False
+    provided_by = inspect.getattr_static(cls, '__providedBy__', None)
+    if (provided_by is not None
+            and provided_by is not objectSpecificationDescriptor):
+        return False
+    provides = inspect.getattr_static(cls, '__provides__', None)
+    if provides is not None and not isinstance(provides, ClassProvides):
+        return False
+    return implementedBy(cls)
+
+
+class RegistryIndex(object):
+    """ Store a domain's dispatches as adapters in ``registry.adapters``.
+
+    This is the default index of :class:`PredicateDomain`.  Lookups are
+    resolved by the adapter registry and cached per combination of provided
+    specifications and name until the registry changes.
+    """
+    def __init__(self, registry, target_interface):
+        self.registry = registry
+        self.target_interface = target_interface
+        self._cache = None
+
+    def find(self, required, name):
+        """ Return the dispatch registered for the interfaces 'required', or
+        for the interfaces they extend, or None.
+        """
+        return self.registry.adapters.lookup(
+            required, self.target_interface, name=name, default=None)
+
+    def register(self, required, name, dispatch):
+        self.registry.adapters.register(
+            required, self.target_interface, name, dispatch)
+        self._cache = None
+
+    def _current_cache(self):
         adapters = self.registry.adapters
-        for_ = [providedBy(x) for x in args]
-        for name, dispatch in adapters.lookupAll(for_, self.target_interface):
-            try:
-                factory = dispatch.match(self.by_phash, *args)
-            except PredicateMismatch:
+        generation = getattr(adapters, '_generation', None)
+        if generation is None:
+            # no way to tell when the registry changes: don't cache
+            return None
+        cache = self._cache
+        if (cache is None or cache.adapters is not adapters
+                or cache.generation != generation):
+            cache = self._cache = _LookupCache(adapters, generation)
+        return cache
+
+    def lookup(self, specs, name):
+        """ Return the dispatch for the provided 'specs' and 'name', or None.
+        """
+        cache = self._current_cache()
+        if cache is not None:
+            dispatch = cache.lookups.get((specs, name), _marker)
+            if dispatch is not _marker:
+                return dispatch
+        dispatch = self.registry.adapters.lookup(
+            specs, self.target_interface, name=name)
+        if cache is not None:
+            # misses are cached too
+            cache.lookups[(specs, name)] = dispatch
+            cache.watch(specs)
+        return dispatch
+
+    def lookup_all(self, specs):
+        """ -> ((name, dispatch), ...) for the provided 'specs'.
+        """
+        cache = self._current_cache()
+        if cache is not None:
+            found = cache.lookup_alls.get(specs)
+            if found is not None:
+                return found
+        found = tuple(
+            self.registry.adapters.lookupAll(specs, self.target_interface))
+        if cache is not None:
+            cache.lookup_alls[specs] = found
+            cache.watch(specs)
+        return found
+
+
+class SpecIndex(object):
+    """ Keep a domain's dispatches in its own table, without going through
+    the adapter registry.
+
+    Select it with ``PredicateDomain(target, registry, index=SpecIndex)``.
+    Dispatches are stored in one tree per number of arguments, with one
+    level per argument keyed by the required interface (classes are
+    required through ``implementedBy``).  Lookups walk the resolution order
+    (``__sro__``) of each provided specification the way the adapter
+    registry resolves multi-adapters, so both indexes pick the same
+    dispatch; the result is cached per combination of provided
+    specifications (i.e. per concrete class for most objects) and name.
+    """
+    def __init__(self, registry, target_interface):
+        self.target_interface = target_interface
+        self._trees = {}
+        self._cache = _LookupCache()
+
+    def find(self, required, name):
+        """ Return the dispatch registered for the interfaces 'required', or
+        for the interfaces they extend, or None.
+        """
+        tree = self._trees.get(len(required))
+        if tree is None:
+            return None
+        return self._find(tree, required, name, 0)
+
+    def _find(self, tree, specs, name, i):
+        last = i + 1 == len(specs)
+        for spec in specs[i].__sro__:
+            branch = tree.get(spec)
+            if branch is None:
+                continue
+            if last:
+                found = branch.get(name)
+            else:
+                found = self._find(branch, specs, name, i + 1)
+            if found is not None:
+                return found
+        return None
+
+    def _find_all(self, tree, specs, i, found):
+        last = i + 1 == len(specs)
+        # least specific first, letting more specific dispatches replace
+        # them, as ``_lookupAll`` does, so names come in the same order
+        for spec in reversed(specs[i].__sro__):
+            branch = tree.get(spec)
+            if branch is None:
                 continue
-            yield name, factory
+            if last:
+                found.update(branch)
+            else:
+                self._find_all(branch, specs, i + 1, found)
+        return found
+
+    def register(self, required, name, dispatch):
+        tree = self._trees.setdefault(len(required), {})
+        for spec in required[:-1]:
+            tree = tree.setdefault(spec, {})
+        # leaves are iterated by ``lookup_all``: replace, don't mutate them
+        leaf = dict(tree.get(required[-1], ()))
+        leaf[name] = dispatch
+        tree[required[-1]] = leaf
+        # a fresh cache, so that a lookup which started before the change
+        # can't store a stale result in it
+        self._cache = _LookupCache()
+
+    def lookup(self, specs, name):
+        """ Return the dispatch for the provided 'specs' and 'name', or None.
+        """
+        cache = self._cache
+        dispatch = cache.lookups.get((specs, name), _marker)
+        if dispatch is _marker:
+            # misses are cached too
+            dispatch = cache.lookups[(specs, name)] = self.find(specs, name)
+            cache.watch(specs)
+        return dispatch
+
+    def lookup_all(self, specs):
+        """ -> ((name, dispatch), ...) for the provided 'specs'.
+        """
+        cache = self._cache
+        found = cache.lookup_alls.get(specs)
+        if found is None:
+            tree = self._trees.get(len(specs))
+            found = ()
+            if tree is not None and specs:
+                found = tuple(self._find_all(tree, specs, 0, {}).items())
+            cache.lookup_alls[specs] = found
+            cache.watch(specs)
+        return found
+
+
+class _LookupCache(object):
+    """ Dispatches (or None when there is no dispatch) resolved by an index,
+    keyed by the specifications provided by the lookup arguments.
+
+    A cache built for an adapter registry is valid for one generation of
+    the registry (the registry bumps its ``_generation`` on every change,
+    including changes to its bases).  Every cache also subscribes to the
+    specifications it holds, like the registry's own lookup caches do, so
+    that declaring new interfaces for a class empties it.
+    """
+    def __init__(self, adapters=None, generation=None):
+        self.adapters = adapters
+        self.generation = generation
+        self.lookups = {}
+        self.lookup_alls = {}
+        self.watched = set()
+
+    def watch(self, specs):
+        for spec in specs:
+            if spec not in self.watched:
+                self.watched.add(spec)
+                spec.subscribe(self)
+
+    def changed(self, originally_changed=None):
+        self.lookups.clear()
+        self.lookup_alls.clear()
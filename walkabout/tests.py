@@ -1,6 +1,8 @@
 import unittest
 
 import pytest
+from zope.interface import Interface
+from zope.interface import implementer
 
 
 @pytest.mark.parametrize("nonstr", [object(), 1, 1.0, b"bytes"])
@@ -35,14 +37,7 @@ class TestTopologicalSorter(unittest.TestCase):
 
     def test_remove(self):
         inst = self._makeOne()
-        inst.names.append('name')
-        inst.name2val['name'] = 1
-        inst.req_after.add('name')
-        inst.req_before.add('name')
-        inst.name2after['name'] = ('bob',)
-        inst.name2before['name'] = ('fred',)
-        inst.order.append(('bob', 'name'))
-        inst.order.append(('name', 'fred'))
+        inst.add('name', 1, after='bob', before='fred')
         inst.remove('name')
         self.assertFalse(inst.names)
         self.assertFalse(inst.req_before)
@@ -50,29 +45,45 @@ class TestTopologicalSorter(unittest.TestCase):
         self.assertFalse(inst.name2before)
         self.assertFalse(inst.name2after)
         self.assertFalse(inst.name2val)
+        self.assertFalse(inst.name2edges)
         self.assertFalse(inst.order)
 
+    def test_remove_leaves_other_arcs(self):
+        from . import LAST
+        inst = self._makeOne()
+        inst.add('name1', 1)
+        inst.add('name2', 2, after='name1')
+        inst.add('name3', 3)
+        inst.remove('name2')
+        self.assertEqual(list(inst.names), ['name1', 'name3'])
+        self.assertEqual(list(inst.order.values()),
+                         [('name1', LAST), ('name3', LAST)])
+
+    def test_remove_missing(self):
+        inst = self._makeOne()
+        self.assertRaises(ValueError, inst.remove, 'name')
+
     def test_add(self):
         from . import LAST
         sorter = self._makeOne()
         sorter.add('name', 'factory')
-        self.assertEqual(sorter.names, ['name'])
+        self.assertEqual(list(sorter.names), ['name'])
         self.assertEqual(sorter.name2val,
                          {'name':'factory'})
-        self.assertEqual(sorter.order, [('name', LAST)])
+        self.assertEqual(list(sorter.order.values()), [('name', LAST)])
         sorter.add('name2', 'factory2')
-        self.assertEqual(sorter.names, ['name',  'name2'])
+        self.assertEqual(list(sorter.names), ['name',  'name2'])
         self.assertEqual(sorter.name2val,
                          {'name':'factory', 'name2':'factory2'})
-        self.assertEqual(sorter.order,
+        self.assertEqual(list(sorter.order.values()),
                          [('name', LAST), ('name2', LAST)])
         sorter.add('name3', 'factory3', before='name2')
-        self.assertEqual(sorter.names,
+        self.assertEqual(list(sorter.names),
                          ['name',  'name2', 'name3'])
         self.assertEqual(sorter.name2val,
                          {'name':'factory', 'name2':'factory2',
                           'name3':'factory3'})
-        self.assertEqual(sorter.order,
+        self.assertEqual(list(sorter.order.values()),
                          [('name', LAST), ('name2', LAST),
                           ('name3', 'name2')])
 
@@ -83,7 +94,67 @@ class TestTopologicalSorter(unittest.TestCase):
         sorter.add('name', 'factory2')
         self.assertEqual(sorter.name2val,
                          {'name':'factory2'})
-        self.assertEqual(sorter.order, [('name', LAST)])
+        self.assertEqual(list(sorter.order.values()), [('name', LAST)])
+
+    def test_add_overwriting_moves_to_end(self):
+        sorter = self._makeOne()
+        sorter.add('name1', 'factory1')
+        sorter.add('name2', 'factory2')
+        sorter.add('name1', 'factory3')
+        self.assertEqual(list(sorter.names), ['name2', 'name1'])
+        self.assertEqual(sorter.sorted(),
+                         [('name2', 'factory2'), ('name1', 'factory3')])
+
+    def test_add_with_iterator(self):
+        sorter = self._makeOne()
+        sorter.add('name1', 'factory1')
+        sorter.add('name2', 'factory2', after=iter(['name1']))
+        self.assertEqual(sorter.name2after, {'name2': ('name1',)})
+        sorter.remove('name2')
+        self.assertEqual(list(sorter.order), list(sorter.name2edges['name1']))
+
+    def test_sorted_is_cached(self):
+        sorter = self._makeOne()
+        sorter.add('name1', 'factory1')
+        calls = []
+        original = sorter._sort
+        def _sort():
+            calls.append(1)
+            return original()
+        sorter._sort = _sort
+        first = sorter.sorted()
+        first.append('mutated')
+        self.assertEqual(sorter.sorted(), [('name1', 'factory1')])
+        self.assertEqual(len(calls), 1)
+
+    def test_sorted_cache_invalidated_by_add(self):
+        sorter = self._makeOne()
+        sorter.add('name1', 'factory1')
+        version = sorter.version
+        self.assertEqual(sorter.sorted(), [('name1', 'factory1')])
+        sorter.add('name2', 'factory2')
+        self.assertTrue(sorter.version > version)
+        self.assertEqual(sorter.sorted(),
+                         [('name1', 'factory1'), ('name2', 'factory2')])
+
+    def test_sorted_cache_invalidated_by_remove(self):
+        sorter = self._makeOne()
+        sorter.add('name1', 'factory1')
+        sorter.add('name2', 'factory2')
+        self.assertEqual(len(sorter.sorted()), 2)
+        sorter.remove('name1')
+        self.assertEqual(sorter.sorted(), [('name2', 'factory2')])
+
+    def test_sorted_error_not_cached(self):
+        from . import SortingError
+        sorter = self._makeOne()
+        sorter.add('auth', 'auth_factory', after='browserid')
+        self.assertRaises(SortingError, sorter.sorted)
+        self.assertRaises(SortingError, sorter.sorted)
+        sorter.add('browserid', 'browserid_factory')
+        self.assertEqual(sorter.sorted(),
+                         [('browserid', 'browserid_factory'),
+                          ('auth', 'auth_factory')])
 
     def test_sorted_ordering_1(self):
         sorter = self._makeOne()
@@ -289,6 +360,289 @@ class TestTopologicalSorter(unittest.TestCase):
         self.assertRaises(CyclicDependencyError, sorter.sorted)
 
 
+    def test_sorted_ordering_conflict_reports_cycle(self):
+        from . import CyclicDependencyError
+        sorter = self._makeOne()
+        add = sorter.add
+        add('browserid', 'browserid_factory')
+        add('auth', 'auth_factory', before='browserid', after='browserid')
+        try:
+            sorter.sorted()
+        except CyclicDependencyError as e:
+            cycledeps = e.args[0]
+        else: # pragma: no cover
+            self.fail('CyclicDependencyError not raised')
+        self.assertEqual(cycledeps['auth'], ['browserid'])
+        self.assertTrue('auth' in cycledeps['browserid'])
+
+    def _makeTweens(self):
+        from . import FIRST
+        sorter = self._makeOne()
+        add = sorter.add
+        add('auth', 'auth_factory', after='browserid')
+        add('dbt', 'dbt_factory')
+        add('retry', 'retry_factory', before='txnmgr', after='exceptionview')
+        add('browserid', 'browserid_factory')
+        add('txnmgr', 'txnmgr_factory', after='exceptionview')
+        add('exceptionview', 'excview_factory', after=FIRST)
+        return sorter
+
+    def test_sorted_layers(self):
+        sorter = self._makeTweens()
+        self.assertEqual(sorter.sorted_layers(),
+                         [
+                             [('exceptionview', 'excview_factory'),
+                              ('dbt', 'dbt_factory'),
+                              ('browserid', 'browserid_factory')],
+                             [('retry', 'retry_factory'),
+                              ('auth', 'auth_factory')],
+                             [('txnmgr', 'txnmgr_factory')],
+                             ])
+
+    def test_sorted_layers_after_last(self):
+        from . import LAST
+        sorter = self._makeOne()
+        sorter.add('name1', 'factory1')
+        sorter.add('name2', 'factory2')
+        sorter.add('name3', 'factory3', after=LAST, before=None)
+        self.assertEqual(sorter.sorted_layers(),
+                         [[('name1', 'factory1'), ('name2', 'factory2')],
+                          [('name3', 'factory3')]])
+
+    def test_sorted_layers_empty(self):
+        sorter = self._makeOne()
+        self.assertEqual(sorter.sorted_layers(), [])
+
+    def test_sorted_layers_cycle(self):
+        from . import CyclicDependencyError
+        sorter = self._makeOne()
+        sorter.add('browserid', 'browserid_factory')
+        sorter.add('auth', 'auth_factory', before='browserid', after='browserid')
+        self.assertRaises(CyclicDependencyError, sorter.sorted_layers)
+
+    def test_ready_done(self):
+        sorter = self._makeTweens()
+        self.assertTrue(sorter.is_active())
+        self.assertEqual(sorter.ready(),
+                         [('exceptionview', 'excview_factory'),
+                          ('dbt', 'dbt_factory'),
+                          ('browserid', 'browserid_factory')])
+        self.assertEqual(sorter.ready(), [])
+        sorter.done('exceptionview')
+        self.assertEqual(sorter.ready(), [('retry', 'retry_factory')])
+        sorter.done('dbt', 'browserid')
+        self.assertEqual(sorter.ready(), [('auth', 'auth_factory')])
+        sorter.done('retry')
+        self.assertTrue(sorter.is_active())
+        self.assertEqual(sorter.ready(), [('txnmgr', 'txnmgr_factory')])
+        sorter.done('auth', 'txnmgr')
+        self.assertFalse(sorter.is_active())
+        self.assertEqual(sorter.ready(), [])
+
+    def test_done_not_ready(self):
+        sorter = self._makeTweens()
+        self.assertRaises(ValueError, sorter.done, 'exceptionview')
+        sorter.ready()
+        self.assertRaises(ValueError, sorter.done, 'retry')
+        sorter.done('exceptionview')
+        self.assertRaises(ValueError, sorter.done, 'exceptionview')
+
+    def test_ready_restarts_after_add(self):
+        sorter = self._makeOne()
+        sorter.add('name1', 'factory1')
+        self.assertEqual(sorter.ready(), [('name1', 'factory1')])
+        sorter.add('name2', 'factory2', after='name1')
+        self.assertEqual(sorter.ready(), [('name1', 'factory1')])
+        sorter.done('name1')
+        self.assertEqual(sorter.ready(), [('name2', 'factory2')])
+
+    def test_ready_unsatisfied(self):
+        from . import SortingError
+        sorter = self._makeOne()
+        sorter.add('auth', 'auth_factory', after='browserid')
+        self.assertRaises(SortingError, sorter.ready)
+
+class TestDynamicTopologicalSorter(unittest.TestCase):
+    def _makeOne(self, *arg, **kw):
+        from . import DynamicTopologicalSorter
+        return DynamicTopologicalSorter(*arg, **kw)
+
+    def test_remove_missing(self):
+        inst = self._makeOne()
+        self.assertRaises(ValueError, inst.remove, 'name')
+
+    def _assertOrdered(self, sorter, *pairs):
+        names = [name for name, _ in sorter.sorted()]
+        for before, after in pairs:
+            self.assertTrue(names.index(before) < names.index(after),
+                            '%s not before %s in %s' % (before, after, names))
+
+    def test_sorted_respects_arcs(self):
+        from . import FIRST
+        sorter = self._makeOne()
+        add = sorter.add
+        add('auth', 'auth_factory', after='browserid')
+        add('dbt', 'dbt_factory')
+        add('retry', 'retry_factory', before='txnmgr', after='exceptionview')
+        add('browserid', 'browserid_factory')
+        add('txnmgr', 'txnmgr_factory', after='exceptionview')
+        add('exceptionview', 'excview_factory', after=FIRST)
+        self.assertEqual(sorted(sorter.sorted()),
+                         [('auth', 'auth_factory'),
+                          ('browserid', 'browserid_factory'),
+                          ('dbt', 'dbt_factory'),
+                          ('exceptionview', 'excview_factory'),
+                          ('retry', 'retry_factory'),
+                          ('txnmgr', 'txnmgr_factory')])
+        self._assertOrdered(sorter,
+                            ('browserid', 'auth'),
+                            ('exceptionview', 'retry'),
+                            ('retry', 'txnmgr'),
+                            ('exceptionview', 'txnmgr'))
+
+    def test_sorted_unconstrained_keeps_insertion_order(self):
+        sorter = self._makeOne()
+        sorter.add('name1', 'factory1')
+        sorter.add('name2', 'factory2')
+        self.assertEqual(sorter.sorted(),
+                         [('name1', 'factory1'), ('name2', 'factory2')])
+
+    def test_add_after_first(self):
+        from . import FIRST
+        sorter = self._makeOne()
+        sorter.add('name1', 'factory1')
+        sorter.add('name2', 'factory2', after=FIRST)
+        self.assertEqual(sorter.sorted(),
+                         [('name1', 'factory1'), ('name2', 'factory2')])
+        sorter.add('name1', 'factory1', after='name2')
+        self.assertEqual(sorter.sorted(),
+                         [('name2', 'factory2'), ('name1', 'factory1')])
+
+    def test_missing_dependency_activated_later(self):
+        sorter = self._makeOne()
+        sorter.add('auth', 'auth_factory', after='browserid')
+        sorter.add('dbt', 'dbt_factory', before='auth')
+        sorter.add('browserid', 'browserid_factory')
+        self._assertOrdered(sorter,
+                            ('browserid', 'auth'),
+                            ('dbt', 'auth'))
+
+    def test_add_conflict_direct(self):
+        from . import CyclicDependencyError
+        sorter = self._makeOne()
+        sorter.add('browserid', 'browserid_factory')
+        self.assertRaises(CyclicDependencyError, sorter.add,
+                          'auth', 'auth_factory',
+                          before='browserid', after='browserid')
+        self.assertEqual(list(sorter.names), ['browserid'])
+        self.assertEqual(sorter.sorted(),
+                         [('browserid', 'browserid_factory')])
+
+    def test_add_conflict_indirect_reports_cycle(self):
+        from . import CyclicDependencyError
+        sorter = self._makeOne()
+        sorter.add('browserid', 'browserid_factory')
+        sorter.add('auth', 'auth_factory', before='browserid')
+        try:
+            sorter.add('dbt', 'dbt_factory', after='browserid',
+                       before='auth')
+        except CyclicDependencyError as e:
+            cycledeps = e.args[0]
+        else: # pragma: no cover
+            self.fail('CyclicDependencyError not raised')
+        self.assertEqual(cycledeps, {'browserid': ['dbt'],
+                                     'dbt': ['auth'],
+                                     'auth': ['browserid']})
+        self.assertEqual(sorter.sorted(),
+                         [('auth', 'auth_factory'),
+                          ('browserid', 'browserid_factory')])
+
+    def test_add_conflict_self(self):
+        from . import CyclicDependencyError
+        sorter = self._makeOne()
+        try:
+            sorter.add('auth', 'auth_factory', after='auth')
+        except CyclicDependencyError as e:
+            self.assertEqual(e.args[0], {'auth': ['auth']})
+        else: # pragma: no cover
+            self.fail('CyclicDependencyError not raised')
+        self.assertFalse(sorter.names)
+
+    def test_add_conflict_from_missing_dependency(self):
+        from . import CyclicDependencyError
+        sorter = self._makeOne()
+        sorter.add('auth', 'auth_factory', after='browserid')
+        sorter.add('dbt', 'dbt_factory', after='auth')
+        self.assertRaises(CyclicDependencyError, sorter.add,
+                          'browserid', 'browserid_factory', after='dbt')
+        self.assertRaises(CyclicDependencyError, sorter.add,
+                          'browserid', 'browserid_factory', before='dbt',
+                          after='dbt')
+        self.assertFalse('browserid' in sorter.names)
+
+    def test_add_conflict_restores_replaced(self):
+        from . import CyclicDependencyError
+        sorter = self._makeOne()
+        sorter.add('browserid', 'browserid_factory')
+        sorter.add('auth', 'auth_factory', after='browserid')
+        self.assertRaises(CyclicDependencyError, sorter.add,
+                          'browserid', 'browserid_factory2', after='auth')
+        self.assertEqual(sorter.name2val['browserid'], 'browserid_factory')
+        self.assertEqual(sorter.sorted(),
+                         [('browserid', 'browserid_factory'),
+                          ('auth', 'auth_factory')])
+
+    def test_remove(self):
+        from . import FIRST
+        sorter = self._makeOne()
+        sorter.add('name1', 'factory1')
+        sorter.add('name2', 'factory2', after=('name1', FIRST))
+        sorter.remove('name1')
+        self.assertEqual(sorter.sorted(), [('name2', 'factory2')])
+        self.assertEqual(list(sorter._out['name1'].values()), ['name2'])
+        sorter.add('name1', 'factory1', before='name2')
+        self.assertEqual(sorter.sorted(),
+                         [('name1', 'factory1'), ('name2', 'factory2')])
+
+    def test_remove_compacts(self):
+        sorter = self._makeOne()
+        for i in range(10):
+            sorter.add(i, i)
+        for i in range(8):
+            sorter.remove(i)
+        self.assertEqual(sorter._holes, 1)
+        self.assertEqual(len(sorter._slots), 5)
+        self.assertEqual(sorter.sorted(), [(8, 8), (9, 9)])
+
+    def test_sorted_unsatisfied_before(self):
+        from . import SortingError
+        sorter = self._makeOne()
+        sorter.add('dbt', 'dbt_factory')
+        sorter.add('retry', 'retry_factory', before='txnmgr')
+        self.assertRaises(SortingError, sorter.sorted)
+        sorter.add('txnmgr', 'txnmgr_factory')
+        self._assertOrdered(sorter, ('retry', 'txnmgr'))
+
+    def test_sorted_unsatisfied_after(self):
+        from . import SortingError
+        sorter = self._makeOne()
+        sorter.add('dbt', 'dbt_factory')
+        sorter.add('auth', 'auth_factory', after='txnmgr')
+        self.assertRaises(SortingError, sorter.sorted)
+
+    def test_sorted_layers(self):
+        sorter = self._makeOne()
+        sorter.add('auth', 'auth_factory', after='browserid')
+        sorter.add('dbt', 'dbt_factory')
+        sorter.add('browserid', 'browserid_factory')
+        self.assertEqual(sorter.sorted_layers(),
+                         [[('dbt', 'dbt_factory'),
+                           ('browserid', 'browserid_factory')],
+                          [('auth', 'auth_factory')]])
+        self.assertEqual(sorter.ready(),
+                         [('dbt', 'dbt_factory'),
+                          ('browserid', 'browserid_factory')])
+
 class TestNotted(unittest.TestCase):
 
     def _makeOne(self, predicate):
@@ -302,6 +656,11 @@ class TestNotted(unittest.TestCase):
         self.assertEqual(inst.phash(), '!val')
         self.assertEqual(inst(None,), False)
 
+    def test_slots(self):
+        from . import not_
+        self.assertFalse(hasattr(self._makeOne(None), '__dict__'))
+        self.assertFalse(hasattr(not_(None), '__dict__'))
+
     def test_it_without_phash_val(self):
         pred = DummyPredicate('', None)
         inst = self._makeOne(pred)
@@ -310,6 +669,65 @@ class TestNotted(unittest.TestCase):
         self.assertEqual(inst(None,), True)
 
 
+class TestLazyPredicate(unittest.TestCase):
+
+    def _makeOne(self, factory, value, api=None, phash='phash'):
+        from . import LazyPredicate
+        return LazyPredicate(factory, value, api, phash)
+
+    def test_created_on_first_call(self):
+        created = []
+        def factory(val, api):
+            created.append((val, api))
+            return DummyPredicate(val, api)
+        inst = self._makeOne(factory, 'val', 'api')
+        self.assertFalse(hasattr(inst, '__dict__'))
+        self.assertEqual(inst.phash(), 'phash')
+        self.assertEqual(created, [])
+        self.assertEqual(inst(None), True)
+        self.assertEqual(inst(None), True)
+        self.assertEqual(created, [('val', 'api')])
+        self.assertEqual(inst.text(), 'val')
+        self.assertEqual(created, [('val', 'api')])
+
+    def test_text(self):
+        inst = self._makeOne(PredicateOne, 'val')
+        self.assertEqual(inst.text(), 'one: val')
+        self.assertEqual(inst(None), False)
+        self.assertTrue(isinstance(inst.predicate, PredicateOne))
+
+
+class Blake2bPhashTests(unittest.TestCase):
+
+    def _makeOne(self):
+        from . import Blake2bPhash
+        return Blake2bPhash()
+
+    def test_it(self):
+        from hashlib import blake2b
+        inst = self._makeOne()
+        digest = blake2b(b'ab', digest_size=16).digest()
+        self.assertEqual(inst(['a', b'b']), int.from_bytes(digest, 'big'))
+        self.assertEqual(inst(['a', '', 'b']), inst(['ab']))
+        self.assertNotEqual(inst(['b', 'a']), inst(['a', 'b']))
+        self.assertEqual(inst([]), inst.default)
+
+
+class MD5PhashTests(unittest.TestCase):
+
+    def _makeOne(self):
+        from . import MD5Phash
+        return MD5Phash()
+
+    def test_it(self):
+        from hashlib import md5
+        from . import DEFAULT_PHASH
+        inst = self._makeOne()
+        self.assertEqual(inst(['a', b'b']), md5(b'ab').hexdigest())
+        self.assertEqual(inst([]), DEFAULT_PHASH)
+        self.assertEqual(inst.default, DEFAULT_PHASH)
+
+
 class TestPredicateList(unittest.TestCase):
 
     def _makeOne(self):
@@ -354,6 +772,76 @@ class TestPredicateList(unittest.TestCase):
         order2, _, _ = inst.make(object(), one=True, three=True)
         self.assertTrue(order1 < order2)
 
+    def test_ordering_same_as_float_orders(self):
+        import itertools
+        from . import MAX_ORDER
+        from . import PredicateList
+        names = ['p%d' % i for i in range(6)]
+        inst = PredicateList()
+        for name in names:
+            inst.add(name, PredicateOne)
+        orders = []
+        for n in range(len(names) + 1):
+            for subset in itertools.combinations(range(len(names)), n):
+                order, _, _ = inst.make(
+                    object(), **dict((names[i], i) for i in subset))
+                score = 0
+                for i in subset:
+                    score |= 1 << i + 1
+                orders.append((order, (MAX_ORDER - score) / (n + 1)))
+        for (order1, old1), (order2, old2) in itertools.product(orders,
+                                                                orders):
+            self.assertEqual(order1 < order2, old1 < old2)
+            self.assertEqual(order1 == order2, old1 == old2)
+        self.assertEqual(inst.make(object())[0], (0, 0))
+
+    def test_ordering_float_orders_bound(self):
+        # the float orders only rank lists by length with 28 or fewer
+        # registered predicates
+        from . import MAX_ORDER
+        from . import PredicateList
+        for count, same in ((28, True), (29, False)):
+            names = ['p%d' % i for i in range(count)]
+            inst = PredicateList()
+            for name in names:
+                inst.add(name, PredicateOne)
+            single, _, _ = inst.make(object(), **{names[-1]: 1})
+            double, _, _ = inst.make(object(), p0=1, p1=1)
+            old_single = (MAX_ORDER - (1 << count)) / 2
+            old_double = (MAX_ORDER - 6) / 3
+            self.assertTrue(double < single)
+            self.assertEqual(old_double < old_single, same)
+
+    def test_ordering_many_predicates(self):
+        from . import PredicateList
+        names = ['p%d' % i for i in range(64)]
+        inst = PredicateList()
+        for name in names:
+            inst.add(name, PredicateOne)
+        all_, _, _ = inst.make(object(), **dict((name, 1) for name in names))
+        first, _, _ = inst.make(object(), p0=1)
+        last, _, _ = inst.make(object(), p63=1)
+        most, _, _ = inst.make(
+            object(), **dict((name, 1) for name in names[1:]))
+        self.assertTrue(all_ < most < last < first < inst.make(object())[0])
+
+    def test_orders_interned(self):
+        inst = self._makeOne()
+        order1, _, _ = inst.make(object(), one=True, three=False)
+        order2, _, _ = inst.make(object(), three=True, one=False)
+        self.assertTrue(order1 is order2)
+
+    def test_ordering_table_cached_until_sorter_changes(self):
+        inst = self._makeOne()
+        table = inst._ordered()
+        self.assertTrue(inst._ordered() is table)
+        self.assertEqual([name for name, _, _ in table],
+                         ['one', 'two', 'three'])
+        self.assertEqual([weight for _, _, weight in table], [2, 4, 8])
+        inst.add('four', PredicateOne, before='one')
+        self.assertEqual([name for name, _, _ in inst._ordered()],
+                         ['one', 'four', 'two', 'three'])
+
     def test_notted(self):
         from . import not_
         _, predicates, _ = self._callFUT(
@@ -369,6 +857,130 @@ class TestPredicateList(unittest.TestCase):
         self.assertEqual(predicates[1](None,), True)
         self.assertEqual(predicates[2](None,), True)
 
+    def test_keyed(self):
+        from . import Keyed
+        from . import PredicateList
+        from . import not_
+        inst = PredicateList()
+        inst.add('method', KeyedPredicate)
+        _, predicates, _ = inst.make(object(), method='GET')
+        self.assertTrue(isinstance(predicates[0], KeyedPredicate))
+        inst = PredicateList(keyed=True)
+        inst.add('method', KeyedPredicate)
+        inst.add('one', PredicateOne)
+        _, predicates, _ = inst.make(object(), method='GET', one=1)
+        self.assertTrue(isinstance(predicates[0], Keyed))
+        self.assertTrue(isinstance(predicates[1], PredicateOne))
+        self.assertFalse(hasattr(predicates[0], '__dict__'))
+        self.assertEqual(predicates[0].name, 'method')
+        self.assertEqual(predicates[0].value, 'GET')
+        self.assertEqual(predicates[0].text(), 'method = GET')
+        self.assertEqual(predicates[0].phash(), 'method = GET')
+        self.assertEqual(predicates[0].dispatch_key(DummyRequest('GET')),
+                         'GET')
+        self.assertTrue(predicates[0](DummyRequest('GET')))
+        _, predicates, _ = inst.make(object(), method=not_('GET'))
+        self.assertFalse(isinstance(predicates[0], Keyed))
+        _, predicates, _ = inst.make(object(), method=['GET'])
+        self.assertFalse(isinstance(predicates[0], Keyed))
+
+    def test_lazy(self):
+        from . import LazyPredicate
+        from . import PredicateList
+        from . import not_
+        created = []
+        def factory(val, api):
+            created.append(val)
+            return KeyedPredicate(val, api)
+        inst = PredicateList()
+        inst.add('method', factory, lazy=True)
+        inst.add('one', PredicateOne, lazy=lambda value: 'ONE %s' % value)
+        _, predicates, phash = inst.make(object(), method='GET', one=1)
+        self.assertEqual(created, [])
+        self.assertTrue(isinstance(predicates[0], LazyPredicate))
+        self.assertEqual(predicates[0].phash(), "method = 'GET'")
+        self.assertEqual(predicates[1].phash(), 'ONE 1')
+        _, predicates2, phash2 = inst.make(object(), method='GET', one=1)
+        self.assertEqual(phash, phash2)
+        self.assertTrue(predicates[0] is predicates2[0])
+        self.assertTrue(predicates[0](DummyRequest('GET')))
+        self.assertEqual(created, ['GET'])
+        _, predicates, _ = inst.make(object(), method=not_('GET'))
+        self.assertEqual(predicates[0].phash(), "!method = 'GET'")
+        self.assertFalse(predicates[0](DummyRequest('GET')))
+        inst.add('method', factory)
+        _, predicates, _ = inst.make(object(), method='GET')
+        self.assertFalse(isinstance(predicates[0], LazyPredicate))
+        self.assertEqual(created, ['GET', 'GET', 'GET'])
+
+    def test_phash(self):
+        from . import not_
+        inst = self._makeOne()
+        _, _, phash1 = inst.make(object(), one='ONE', two=not_('TWO'))
+        _, _, phash2 = inst.make(object(), two=not_('TWO'), one='ONE')
+        _, _, phash3 = inst.make(object(), one='ONE', two='TWO')
+        _, _, phash4 = inst.make(object())
+        self.assertEqual(phash1, phash2)
+        self.assertNotEqual(phash1, phash3)
+        self.assertNotEqual(phash1, phash4)
+        self.assertEqual(inst.make(object())[2], phash4)
+        self.assertEqual(phash4, inst.phasher.default)
+
+    def test_md5_phash(self):
+        from hashlib import md5
+        from . import DEFAULT_PHASH
+        from . import MD5Phash
+        from . import PredicateList
+        inst = PredicateList(MD5Phash)
+        inst.add('one', PredicateOne)
+        inst.add('zero', DummyPredicate)
+        _, _, phash = inst.make(object(), one='ONE', zero=['a', 'b'])
+        self.assertEqual(phash, md5(b'one: ONEab').hexdigest())
+        self.assertEqual(inst.make(object())[2], DEFAULT_PHASH)
+
+    def test_interned(self):
+        from . import not_
+        inst = self._makeOne()
+        _, predicates1, _ = inst.make(object(), one='ONE', two='TWO')
+        _, predicates2, _ = inst.make(object(), one='ONE', two=not_('TWO'))
+        _, predicates3, _ = inst.make(object(), one='ONE', two='TWO2')
+        self.assertTrue(predicates1[0] is predicates2[0])
+        self.assertTrue(predicates1[0] is predicates3[0])
+        self.assertFalse(predicates1[1] is predicates2[1])
+        self.assertFalse(predicates1[1] is predicates3[1])
+
+    def test_interned_per_name_and_factory(self):
+        from . import PredicateList
+        inst = PredicateList()
+        inst.add('zero', DummyPredicate)
+        inst.add('other', DummyPredicate)
+        _, predicates1, _ = inst.make(object(), zero='ZERO', other='ZERO')
+        self.assertFalse(predicates1[0] is predicates1[1])
+        inst.add('zero', PredicateOne)
+        _, predicates2, _ = inst.make(object(), zero='ZERO')
+        self.assertFalse(predicates2[0] is predicates1[0])
+
+    def test_interned_iterable_phash(self):
+        from . import PredicateList
+        inst = PredicateList()
+        inst.add('zero', DummyPredicate)
+        _, predicates1, _ = inst.make(object(), zero=['a', 'b'])
+        _, predicates2, _ = inst.make(object(), zero=['a', 'b'])
+        self.assertTrue(predicates1[0] is predicates2[0])
+
+    def test_not_interned(self):
+        from . import PredicateList
+        inst = PredicateList()
+        inst.add('zero', DummyPredicate)
+        # empty phash
+        _, predicates1, _ = inst.make(object(), zero='')
+        _, predicates2, _ = inst.make(object(), zero='')
+        self.assertFalse(predicates1[0] is predicates2[0])
+        # unhashable phash
+        _, predicates1, _ = inst.make(object(), zero=[bytearray(b'a')])
+        _, predicates2, _ = inst.make(object(), zero=[bytearray(b'a')])
+        self.assertFalse(predicates1[0] is predicates2[0])
+
     def test_unknown_predictate(self):
         from . import SortingError
         self.assertRaises(SortingError,
@@ -391,6 +1003,13 @@ class PredicateDispatchTests(unittest.TestCase):
         mv = self._makeOne()
         self.assertEqual(mv.candidates, [])
 
+    def test_slots(self):
+        mv = self._makeOne()
+        self.assertFalse(hasattr(mv, '__dict__'))
+        mv.add('view', (0, 0), 'abc')
+        mv.candidates.append(None)
+        self.assertEqual(mv.candidates, [((0, 0), 'view', 'abc')])
+
     def test___discriminator__(self):
         class Discriminating(object):
             def __discriminator__(self, *args):
@@ -405,6 +1024,23 @@ class PredicateDispatchTests(unittest.TestCase):
         mv.add('view', 100)
         self.assertEqual(mv.candidates, [(100, 'view', None)])
 
+    def test_add_publishes_lazily(self):
+        mv = self._makeOne()
+        mv.add('view', 100)
+        self.assertTrue(mv._state is None)
+        self.assertEqual(mv.candidates, [(100, 'view', None)])
+        state = mv._state
+        self.assertEqual(state, ((100,), ('view',), (None,)))
+        self.assertEqual(mv.match({}), 'view')
+        self.assertTrue(mv._state is state)
+        mv.add('view2', 99)
+        mv.add('view3', 101)
+        self.assertTrue(mv._state is None)
+        self.assertEqual(mv.match({}), 'view2')
+        self.assertEqual(mv._state,
+                         ((99, 100, 101), ('view2', 'view', 'view3'),
+                          (None, None, None)))
+
     def test_add_multiple(self):
         mv = self._makeOne()
         mv.add('view', 100)
@@ -429,6 +1065,56 @@ class PredicateDispatchTests(unittest.TestCase):
         mv.add('view2', 100, phash='abc')
         self.assertEqual(mv.candidates, [(100, 'view2', 'abc')])
 
+    def test_add_with_phash_replacing_among_equal_orders(self):
+        mv = self._makeOne()
+        mv.add('view1', 100, phash='abc')
+        mv.add('view2', 100, phash='def')
+        mv.add('view3', 100, phash='ghi')
+        mv.add('view4', 100, phash='def')
+        self.assertEqual(mv.candidates, [(100, 'view1', 'abc'),
+                                         (100, 'view4', 'def'),
+                                         (100, 'view3', 'ghi')])
+
+    def test_add_with_phash_replacing_different_order(self):
+        mv = self._makeOne()
+        mv.add('view1', 100, phash='abc')
+        mv.add('view2', 99, phash='def')
+        mv.add('view3', 98, phash='abc')
+        self.assertEqual(mv.candidates, [(98, 'view3', 'abc'),
+                                         (99, 'view2', 'def')])
+        mv.add('view4', 100, phash='abc')
+        self.assertEqual(mv.candidates, [(99, 'view2', 'def'),
+                                         (100, 'view4', 'abc')])
+
+    def test_add_stable_for_equal_orders(self):
+        mv = self._makeOne()
+        mv.add('view1', 100)
+        mv.add('view2', 99)
+        mv.add('view3', 100)
+        mv.add('view4', 99)
+        self.assertEqual([v for _, v, _ in mv.candidates],
+                         ['view2', 'view4', 'view1', 'view3'])
+
+    def test_add_many(self):
+        mv = self._makeOne()
+        mv.add('view', 100, phash='abc')
+        mv.add_many([('view2', 99, 'def'),
+                     ('view3', 100, None),
+                     ('view4', 100, 'abc'),
+                     ('view5', 98, 'ghi'),
+                     ('view6', 99, 'ghi')])
+        self.assertEqual(mv.candidates, [(99, 'view2', 'def'),
+                                         (99, 'view6', 'ghi'),
+                                         (100, 'view4', 'abc'),
+                                         (100, 'view3', None)])
+        mv.add('view7', 99, 'def')
+        mv.add('view8', 99)
+        self.assertEqual(mv.candidates, [(99, 'view7', 'def'),
+                                         (99, 'view6', 'ghi'),
+                                         (99, 'view8', None),
+                                         (100, 'view4', 'abc'),
+                                         (100, 'view3', None)])
+
     def test_multiple_with_functions_as_views(self):
         # this failed on py3 at one point, because functions aren't orderable
         # and we were sorting the views via a plain sort() rather than
@@ -470,6 +1156,469 @@ class PredicateDispatchTests(unittest.TestCase):
         self.assertTrue(mv.match(by_phash, 'a', 'b') is candidate2)
 
 
+    def test_match_w_matcher(self):
+        built = []
+        class Matcher(object):
+            def __init__(self, dispatch, by_phash):
+                built.append(list(dispatch))
+            def __call__(self, *args):
+                return ''.join(args)
+        mv = self._getTargetClass()('name', Matcher)
+        mv.add('view1', 100)
+        by_phash = {}
+        self.assertEqual(mv.match(by_phash, 'a', 'b'), 'ab')
+        self.assertEqual(mv.match(by_phash, 'c'), 'c')
+        self.assertEqual(len(built), 1)
+        mv.add('view2', 100)
+        mv.match(by_phash, 'a')
+        self.assertEqual(built[-1], [(100, 'view1', None),
+                                     (100, 'view2', None)])
+        mv.add_many([('view3', 100, None)])
+        mv.match({}, 'a')
+        self.assertEqual(len(built), 3)
+
+    def test_match_w_matcher_miss(self):
+        from . import PredicateMismatch
+        from . import TreeMatcher
+        mv = self._getTargetClass()('name', TreeMatcher)
+        mv.add(object(), 100, 'abc')
+        by_phash = {'abc': [lambda *args: False]}
+        self.assertRaises(PredicateMismatch, mv.match, by_phash, 'a')
+
+
+class CountingPredicate(object):
+    def __init__(self, val, result, calls):
+        self.val = val
+        self.result = result
+        self.calls = calls
+    def __call__(self, *args):
+        self.calls.append(self.val)
+        return self.result
+    def phash(self):
+        return self.val
+    text = phash
+
+
+class _MatcherTests(object):
+    # shared by the PredicateDispatch matcher tests; ``_getTargetClass``
+    # returns the matcher factory.
+
+    def _makeDispatch(self, entries):
+        from . import PredicateDispatch
+        dispatch = PredicateDispatch('name')
+        for order, candidate, phash in entries:
+            dispatch.add(candidate, order, phash)
+        return dispatch
+
+    def _makeOne(self, entries, by_phash):
+        return self._getTargetClass()(self._makeDispatch(entries), by_phash)
+
+    def _assertSameAsScan(self, entries, by_phash, *args):
+        from . import _marker
+        dispatch = self._makeDispatch(entries)
+        expected = dispatch._select(by_phash, args)
+        matcher = self._getTargetClass()(dispatch, by_phash)
+        self.assertTrue(matcher(*args) is expected)
+        return expected
+
+    def test_no_candidates(self):
+        from . import _marker
+        matcher = self._makeOne([], {})
+        self.assertTrue(matcher('a') is _marker)
+
+    def test_unpredicated_candidate(self):
+        calls = []
+        by_phash = {'p': [CountingPredicate('one', False, calls)]}
+        found = self._assertSameAsScan(
+            [(1, 'c1', 'p'), (2, 'c2', None), (3, 'c3', 'p')], by_phash, 'a')
+        self.assertEqual(found, 'c2')
+
+    def test_first_match_in_order(self):
+        calls = []
+        yes = CountingPredicate('yes', True, calls)
+        no = CountingPredicate('no', False, calls)
+        by_phash = {
+            'p1': [yes, no],
+            'p2': [no],
+            'p3': [yes],
+            'p4': [],
+            }
+        found = self._assertSameAsScan(
+            [(1, 'c1', 'p1'), (2, 'c2', 'p2'), (3, 'c3', 'p3'),
+             (4, 'c4', 'p4')],
+            by_phash, 'a')
+        self.assertEqual(found, 'c3')
+
+    def test_miss(self):
+        from . import _marker
+        calls = []
+        no = CountingPredicate('no', False, calls)
+        found = self._assertSameAsScan(
+            [(1, 'c1', 'p1'), (2, 'c2', 'p2')],
+            {'p1': [no], 'p2': [CountingPredicate('yes', True, calls), no]},
+            'a')
+        self.assertTrue(found is _marker)
+
+    def test_notted_predicates(self):
+        from . import Notted
+        calls = []
+        get = CountingPredicate('GET', True, calls)
+        by_phash = {
+            'p1': [Notted(CountingPredicate('GET', True, calls))],
+            'p2': [get],
+            }
+        found = self._assertSameAsScan(
+            [(1, 'c1', 'p1'), (2, 'c2', 'p2')], by_phash, 'a')
+        self.assertEqual(found, 'c2')
+        # the negated and plain predicates are distinct: two calls each for
+        # the scan and the matcher
+        self.assertEqual(len(calls), 4)
+
+    def test_pretend_predicates_not_shared(self):
+        calls = []
+        by_phash = {
+            'p1': [CountingPredicate('', False, calls)],
+            'p2': [CountingPredicate('', True, calls)],
+            }
+        found = self._assertSameAsScan(
+            [(1, 'c1', 'p1'), (2, 'c2', 'p2')], by_phash, 'a')
+        self.assertEqual(found, 'c2')
+
+    def test_multiple_hashes(self):
+        calls = []
+        class Multi(CountingPredicate):
+            def phash(self):
+                return ['a', self.val]
+        by_phash = {
+            'p1': [Multi('one', False, calls)],
+            'p2': [Multi('one', False, calls)],
+            'p3': [Multi('two', True, calls)],
+            }
+        found = self._assertSameAsScan(
+            [(1, 'c1', 'p1'), (2, 'c2', 'p2'), (3, 'c3', 'p3')],
+            by_phash, 'a')
+        self.assertEqual(found, 'c3')
+
+
+class _SharingMatcherTests(_MatcherTests):
+
+    def test_shared_predicate_evaluated_once(self):
+        calls = []
+        def pred(val, result):
+            return CountingPredicate(val, result, calls)
+        by_phash = {
+            'p1': [pred('GET', True), pred('json', False)],
+            'p2': [pred('GET', True), pred('xml', False)],
+            'p3': [pred('POST', False), pred('xml', False)],
+            'p4': [pred('GET', True), pred('html', True)],
+            }
+        matcher = self._makeOne(
+            [(1, 'c1', 'p1'), (2, 'c2', 'p2'), (3, 'c3', 'p3'),
+             (4, 'c4', 'p4')],
+            by_phash)
+        self.assertEqual(matcher('a'), 'c4')
+        self.assertEqual(sorted(set(calls)), sorted(calls))
+        self.assertEqual(calls.count('GET'), 1)
+        count = len(calls)
+        del calls[:]
+        self.assertEqual(matcher('a'), 'c4')
+        self.assertEqual(len(calls), count)
+
+
+class FrozenDispatchTests(unittest.TestCase):
+
+    def _makeOne(self, dispatch, by_phash):
+        from . import FrozenDispatch
+        return FrozenDispatch(dispatch, by_phash)
+
+    def test_it(self):
+        from . import PredicateDispatch
+        from . import PredicateMismatch
+        from . import _marker
+        dispatch = PredicateDispatch('name')
+        one = PredicateOne('ONE', None)
+        zero = DummyPredicate('ZERO', None)
+        by_phash = {'one': [zero, one], 'zero': [zero]}
+        dispatch.add('one', (-2, -6), 'one')
+        dispatch.add('zero', (-1, -2), 'zero')
+        dispatch.add('none', (0, 0))
+        inst = self._makeOne(dispatch, by_phash)
+        self.assertEqual(inst.name, 'name')
+        self.assertEqual(list(inst), [('one', (zero, one)),
+                                      ('zero', (zero,)),
+                                      ('none', ())])
+        self.assertEqual(inst.match(None), 'zero')
+        self.assertFalse(hasattr(inst, '__dict__'))
+        inst = self._makeOne(PredicateDispatch('name'), by_phash)
+        self.assertTrue(inst.select(None) is _marker)
+        self.assertRaises(PredicateMismatch, inst.match, None)
+
+    def test_compiled(self):
+        from . import PredicateDispatch
+        dispatch = PredicateDispatch('name')
+        by_phash = {'zero': [DummyPredicate('ZERO', None)]}
+        dispatch.add('zero', (-1, -2), 'zero')
+        dispatch.compile(by_phash)
+        inst = self._makeOne(dispatch, by_phash)
+        self.assertTrue(inst._matcher is dispatch._matcher[2])
+        self.assertEqual(inst.match(None), 'zero')
+        self.assertTrue(self._makeOne(dispatch, {'zero': []})._matcher is None)
+
+
+class PackedDispatchTests(FrozenDispatchTests):
+
+    def _makeOne(self, dispatch, by_phash):
+        from . import PackedDispatch
+        return PackedDispatch(dispatch, by_phash)
+
+    def test_packed(self):
+        from . import PredicateDispatch
+        dispatch = PredicateDispatch('name')
+        one = PredicateOne('ONE', None)
+        zero = DummyPredicate('ZERO', None)
+        by_phash = {'one': (zero, one)}
+        dispatch.add('one', (-2, -6), 'one')
+        dispatch.add('none', (0, 0))
+        inst = self._makeOne(dispatch, by_phash)
+        self.assertEqual(inst.packed, ('one', 2, zero, one, 'none', 0))
+        self.assertEqual(inst.match(None), 'none')
+
+
+class TreeMatcherTests(_SharingMatcherTests, unittest.TestCase):
+
+    def _getTargetClass(self):
+        from . import TreeMatcher
+        return TreeMatcher
+
+    def test_tree_groups_common_prefixes(self):
+        calls = []
+        get = CountingPredicate('GET', True, calls)
+        json = CountingPredicate('json', True, calls)
+        by_phash = {'p1': [get, json], 'p2': [get], 'p3': [json]}
+        matcher = self._makeOne(
+            [(1, 'c1', 'p1'), (2, 'c2', 'p2'), (3, 'c3', 'p3')], by_phash)
+        self.assertEqual(matcher.tree,
+                         [(0, [(1, [(None, 'c1')]), (None, 'c2')]),
+                          (1, [(None, 'c3')])])
+
+class BitmaskMatcherTests(_SharingMatcherTests, unittest.TestCase):
+
+    def _getTargetClass(self):
+        from . import BitmaskMatcher
+        return BitmaskMatcher
+
+    def test_masks(self):
+        calls = []
+        get = CountingPredicate('GET', True, calls)
+        json = CountingPredicate('json', True, calls)
+        by_phash = {'p1': [get, json, get], 'p2': [json],
+                    'p4': [get, json, get]}
+        matcher = self._makeOne(
+            [(1, 'c1', 'p1'), (2, 'c2', 'p2'), (3, 'c3', None),
+             (4, 'c4', 'p4')], by_phash)
+        self.assertEqual(matcher.entries,
+                         (('c1', 3, ((1, get), (2, json))),
+                          ('c2', 2, ((2, json),)),
+                          ('c3', 0, ()),
+                          ('c4', 3, ((1, get), (2, json)))))
+
+    def test_known_false_skips_candidates(self):
+        calls = []
+        no = CountingPredicate('no', False, calls)
+        yes = CountingPredicate('yes', True, calls)
+        by_phash = {'p1': [no, yes], 'p2': [yes, no], 'p3': [yes]}
+        matcher = self._makeOne(
+            [(1, 'c1', 'p1'), (2, 'c2', 'p2'), (3, 'c3', 'p3')], by_phash)
+        self.assertEqual(matcher('a'), 'c3')
+        self.assertEqual(calls, ['no', 'yes'])
+
+class KeyedMatcherTests(_MatcherTests, unittest.TestCase):
+
+    def _getTargetClass(self):
+        from . import KeyedMatcher
+        return KeyedMatcher
+
+    def _keyed(self, val, calls, name='method'):
+        from . import Keyed
+        return Keyed(KeyedPredicate(val, calls), name, val)
+
+    def test_index(self):
+        calls = []
+        get = self._keyed('GET', calls)
+        post = self._keyed('POST', calls)
+        json = CountingPredicate('json', True, calls)
+        by_phash = {'p1': [get, json], 'p2': [json], 'p3': [post],
+                    'p4': [json, get]}
+        matcher = self._makeOne(
+            [(1, 'c1', 'p1'), (2, 'c2', 'p2'), (3, 'c3', 'p3'),
+             (4, 'c4', 'p4'), (5, 'c5', None)], by_phash)
+        self.assertTrue(matcher.key_predicate is get)
+        self.assertEqual(matcher.index,
+                         {'GET': (('c1', (json,)), ('c2', (json,)),
+                                  ('c4', (json,)), ('c5', ())),
+                          'POST': (('c2', (json,)), ('c3', ()),
+                                   ('c5', ()))})
+        self.assertEqual(matcher.fallback, (('c2', (json,)), ('c5', ())))
+
+    def test_lookup_by_key(self):
+        calls = []
+        no = CountingPredicate('no', False, calls)
+        by_phash = {'p1': [self._keyed('GET', calls), no],
+                    'p2': [self._keyed('POST', calls)],
+                    'p3': [self._keyed('GET', calls)]}
+        matcher = self._makeOne(
+            [(1, 'c1', 'p1'), (2, 'c2', 'p2'), (3, 'c3', 'p3')], by_phash)
+        self.assertEqual(matcher(DummyRequest('GET')), 'c3')
+        self.assertEqual(calls, ['no'])
+        del calls[:]
+        self.assertEqual(matcher(DummyRequest('POST')), 'c2')
+        self.assertEqual(calls, [])
+        from . import _marker
+        self.assertTrue(matcher(DummyRequest('PUT')) is _marker)
+
+    def test_lookup_unhashable_key(self):
+        calls = []
+        by_phash = {'p1': [self._keyed('GET', calls)],
+                    'p2': [self._keyed('POST', calls)]}
+        matcher = self._makeOne([(1, 'c1', 'p1'), (2, 'c2', 'p2')], by_phash)
+        from . import _marker
+        self.assertTrue(matcher(DummyRequest(['GET'])) is _marker)
+        self.assertEqual(calls, ['GET', 'POST'])
+
+    def test_same_as_scan_with_keys(self):
+        from . import Notted
+        calls = []
+        request = DummyRequest('GET')
+        by_phash = {
+            'p1': [self._keyed('GET', calls), Notted(self._keyed('GET', calls))],
+            'p2': [Notted(KeyedPredicate('POST', calls))],
+            'p3': [self._keyed('GET', calls)],
+            }
+        found = self._assertSameAsScan(
+            [(1, 'c1', 'p1'), (2, 'c2', 'p2'), (3, 'c3', 'p3')],
+            by_phash, request)
+        self.assertEqual(found, 'c2')
+
+class AdaptiveMatcherTests(_MatcherTests, unittest.TestCase):
+
+    def _getTargetClass(self):
+        from . import AdaptiveMatcher
+        return AdaptiveMatcher
+
+    def test_sampled_lookups_reorder(self):
+        calls = []
+        yes = CountingPredicate('yes', True, calls)
+        no = CountingPredicate('no', False, calls)
+        by_phash = {'p1': [yes, no], 'p2': [yes]}
+        dispatch = self._makeDispatch([(1, 'c1', 'p1'), (2, 'c2', 'p2')])
+        matcher = self._getTargetClass()(
+            dispatch, by_phash, sample=2, interval=2)
+        self.assertEqual(matcher('a'), 'c2')
+        self.assertEqual(calls, ['yes', 'no', 'yes'])
+        del calls[:]
+        # sampled: the same predicates are called
+        self.assertEqual(matcher('a'), 'c2')
+        self.assertEqual(calls, ['yes', 'no', 'yes'])
+        self.assertEqual(matcher.calls, [2, 1])
+        self.assertEqual(matcher.rejections, [0, 1])
+        self.assertEqual(matcher.entries[0][1], (yes, no))
+        matcher('a')
+        del calls[:]
+        self.assertEqual(matcher('a'), 'c2')
+        self.assertEqual(matcher.entries[0][1], (no, yes))
+        self.assertEqual(matcher.entries[0][2], (1, 0))
+        self.assertEqual(matcher.calls, [2, 1])
+        self.assertEqual(matcher.rejections, [0, 1])
+        del calls[:]
+        self.assertEqual(matcher('a'), 'c2')
+        self.assertEqual(calls, ['no', 'yes'])
+
+    def test_sampled_lookups_short_circuit(self):
+        calls = []
+        no = CountingPredicate('no', False, calls)
+        guarded = CountingPredicate('guarded', True, calls)
+        by_phash = {'p1': [no, guarded], 'p2': []}
+        dispatch = self._makeDispatch([(1, 'c1', 'p1'), (2, 'c2', 'p2')])
+        matcher = self._getTargetClass()(
+            dispatch, by_phash, sample=1, interval=1)
+        self.assertEqual(matcher('a'), 'c2')
+        self.assertEqual(calls, ['no'])
+        self.assertEqual(matcher.calls, [0.5, 0])
+        self.assertEqual(matcher.rejections, [0.5, 0])
+
+    def test_reorder_by_cost(self):
+        calls = []
+        one = CountingPredicate('one', True, calls)
+        two = CountingPredicate('two', True, calls)
+        three = CountingPredicate('three', True, calls)
+        by_phash = {'p1': [one, two, three], 'p2': [three, one]}
+        matcher = self._makeOne([(1, 'c1', 'p1'), (2, 'c2', 'p2')], by_phash)
+        matcher.calls = [4.0, 1.0, 2.0]
+        matcher.costs = [4.0, 1.0, 3.0]
+        matcher.rejections = [2.0, 1.0, 0.0]
+        matcher.reorder()
+        self.assertEqual([preds for c, preds, slots in matcher.entries],
+                         [(two, one, three), (one, three)])
+        self.assertEqual(matcher.costs, [2.0, 0.5, 1.5])
+        self.assertEqual(matcher('a'), 'c1')
+
+
+class SampledAdaptiveMatcherTests(AdaptiveMatcherTests):
+
+    def _getTargetClass(self):
+        import functools
+        from . import AdaptiveMatcher
+        return functools.partial(AdaptiveMatcher, sample=1, interval=1)
+
+
+class CompileMatcherTests(_MatcherTests, unittest.TestCase):
+
+    def _getTargetClass(self):
+        from . import compile_matcher
+        return compile_matcher
+
+    def test_source(self):
+        from . import Keyed
+        from . import Notted
+        calls = []
+        by_phash = {
+            'p1': [CountingPredicate('one', True, calls),
+                   Notted(CountingPredicate('two', True, calls))],
+            'p2': [Notted(CountingPredicate('', True, calls)),
+                   Keyed(KeyedPredicate('GET', calls), 'method', 'GET')],
+            'p3': [],
+            }
+        matcher = self._makeOne(
+            [(1, 'c1', 'p1'), (2, 'c2', 'p2'), (3, 'c3', 'p3'),
+             (4, 'c4', None)], by_phash)
+        self.assertEqual(matcher.source.splitlines(), [
+            'def match(*args):',
+            '    if p0_0(*args) and not p0_1(*args):',
+            '        return c0',
+            '    if p1_0(*args) and p1_1(*args):',
+            '        return c1',
+            '    return c2',
+            ])
+        self.assertEqual(matcher(DummyRequest('POST')), 'c3')
+        self.assertEqual(matcher(DummyRequest('GET')), 'c2')
+
+    def test_dispatch_compile(self):
+        from . import PredicateDispatch
+        from . import PredicateMismatch
+        calls = []
+        by_phash = {'p1': [CountingPredicate('one', False, calls)],
+                    'p2': [CountingPredicate('two', True, calls)]}
+        dispatch = PredicateDispatch('name')
+        dispatch.add('c1', 1, 'p1')
+        dispatch.compile(by_phash)
+        self.assertTrue(dispatch._matcher[2].source)
+        self.assertRaises(PredicateMismatch, dispatch.match, by_phash, 'a')
+        # a different by_phash falls back to the scan
+        self.assertEqual(dispatch.match({'p1': []}, 'a'), 'c1')
+        dispatch.add('c2', 2, 'p2')
+        self.assertTrue(dispatch._matcher is None)
+        self.assertEqual(dispatch.match(by_phash, 'a'), 'c2')
+
 class PredicateDomainTests(unittest.TestCase):
 
     def _getTargetClass(self):
@@ -552,25 +1701,42 @@ class PredicateDomainTests(unittest.TestCase):
         found = domain.lookup(Bar())
         self.assertTrue(found is candidate)
 
-    def test_lookup_extra_kw(self):
-        from zope.interface import Interface
-        from zope.interface.registry import Components
-        class IFoo(Interface): pass
-        registry = Components()
-        domain = self._makeOne(IFoo, registry)
-        self.assertRaises(TypeError, domain.lookup, object(),
-                            unknown='UNKNOWN')
-
-    def test_lookup_miss(self):
+    def test_add_candidates(self):
         from zope.interface import Interface
+        from zope.interface import implementer
         from zope.interface.registry import Components
-        from . import PredicateMismatch
         class IFoo(Interface): pass
+        class IBar(Interface): pass
+        @implementer(IBar)
+        class Bar(object): pass
         registry = Components()
+        candidate1 = object()
+        candidate2 = object()
+        candidate3 = object()
         domain = self._makeOne(IFoo, registry)
-        self.assertRaises(PredicateMismatch, domain.lookup, object())
-
-    def test_lookup_with_name(self):
+        registered = []
+        register = domain.index.register
+        def _register(*arg):
+            registered.append(arg)
+            return register(*arg)
+        domain.index.register = _register
+        domain.add_predicate('zero', DummyPredicate)
+        domain.add_predicate('one', PredicateOne)
+        domain.add_candidates([
+            (candidate1, (IBar,), {'one': 'ONE'}),
+            (candidate2, (Bar,), {'zero': 'ZERO'}),
+            (candidate3, (IBar,), {'zero': 'ZERO'}),
+            (candidate3, (IBar,), {'name': 'other'}),
+            ])
+        # Bar's registration reuses the dispatch registered for IBar
+        self.assertEqual(len(registered), 2)
+        self.assertTrue(domain.lookup(Bar()) is candidate3)
+        self.assertTrue(domain.lookup(Bar(), name='other') is candidate3)
+        self.assertEqual(len(domain.by_phash), 3)
+        for preds in domain.by_phash.values():
+            self.assertTrue(isinstance(preds, tuple))
+
+    def test_batch(self):
         from zope.interface import Interface
         from zope.interface import implementer
         from zope.interface.registry import Components
@@ -580,7 +1746,131 @@ class PredicateDomainTests(unittest.TestCase):
         @implementer(IBar)
         class Bar(object): pass
         registry = Components()
-        candidate = object()
+        candidate1 = object()
+        candidate2 = object()
+        domain = self._makeOne(IFoo, registry)
+        domain.add_predicate('zero', DummyPredicate)
+        domain.add_predicate('one', PredicateOne)
+        with domain.batch():
+            domain.add_candidate(candidate1, IBar, zero='ZERO')
+            with domain.batch():
+                domain.add_candidate(candidate2, IBar, one='ONE')
+            self.assertRaises(PredicateMismatch, domain.lookup, Bar())
+        self.assertTrue(domain.lookup(Bar()) is candidate1)
+
+    def test_batch_validates_eagerly(self):
+        from zope.interface import Interface
+        from zope.interface.registry import Components
+        from . import SortingError
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        registry = Components()
+        domain = self._makeOne(IFoo, registry)
+        with domain.batch():
+            self.assertRaises(SortingError, domain.add_candidate,
+                              object(), IBar, nonesuch='NONESUCH')
+            self.assertRaises(ValueError, domain.add_candidate,
+                              object(), None)
+
+    def test_batch_discarded_on_error(self):
+        from zope.interface import Interface
+        from zope.interface import implementer
+        from zope.interface.registry import Components
+        from . import PredicateMismatch
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        @implementer(IBar)
+        class Bar(object): pass
+        registry = Components()
+        domain = self._makeOne(IFoo, registry)
+        domain.add_predicate('zero', DummyPredicate)
+        def _add():
+            with domain.batch():
+                domain.add_candidate(object(), IBar, zero='ZERO')
+                raise RuntimeError
+        self.assertRaises(RuntimeError, _add)
+        self.assertRaises(PredicateMismatch, domain.lookup, Bar())
+        self.assertFalse(domain.by_phash)
+        candidate = object()
+        domain.add_candidate(candidate, IBar, zero='ZERO')
+        self.assertTrue(domain.lookup(Bar()) is candidate)
+
+    def test_matcher(self):
+        from zope.interface import Interface
+        from zope.interface import implementer
+        from zope.interface.registry import Components
+        from . import TreeMatcher
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        @implementer(IBar)
+        class Bar(object): pass
+        registry = Components()
+        candidate1 = object()
+        candidate2 = object()
+        domain = self._getTargetClass()(IFoo, registry, matcher=TreeMatcher)
+        domain.add_predicate('zero', DummyPredicate)
+        domain.add_predicate('one', PredicateOne)
+        domain.add_candidate(candidate1, IBar, one='ONE', zero='ZERO')
+        domain.add_candidate(candidate2, IBar, zero='ZERO')
+        self.assertTrue(domain.lookup(Bar()) is candidate2)
+        dispatch = registry.adapters.lookup((IBar,), IFoo)
+        self.assertTrue(isinstance(dispatch._matcher[2], TreeMatcher))
+
+    def test_keyed_matcher(self):
+        from zope.interface import Interface
+        from zope.interface import implementer
+        from zope.interface.registry import Components
+        from . import Keyed
+        from . import KeyedMatcher
+        from . import PredicateMismatch
+        from . import not_
+        class IFoo(Interface): pass
+        class IRequest(Interface): pass
+        @implementer(IRequest)
+        class Request(DummyRequest): pass
+        registry = Components()
+        domain = self._getTargetClass()(IFoo, registry, matcher=KeyedMatcher)
+        domain.add_predicate('method', KeyedPredicate)
+        domain.add_candidate('get', IRequest, method='GET')
+        domain.add_candidate('post', IRequest, method='POST')
+        domain.add_candidate('notput', IRequest, method=not_('PUT'))
+        dispatch = registry.adapters.lookup((IRequest,), IFoo)
+        self.assertTrue(isinstance(
+            domain.by_phash[dispatch.candidates[0][2]][0], Keyed))
+        self.assertEqual(domain.lookup(Request('GET')), 'get')
+        self.assertEqual(domain.lookup(Request('POST')), 'post')
+        self.assertEqual(domain.lookup(Request('HEAD')), 'notput')
+        self.assertRaises(PredicateMismatch, domain.lookup, Request('PUT'))
+
+    def test_lookup_extra_kw(self):
+        from zope.interface import Interface
+        from zope.interface.registry import Components
+        class IFoo(Interface): pass
+        registry = Components()
+        domain = self._makeOne(IFoo, registry)
+        self.assertRaises(TypeError, domain.lookup, object(),
+                            unknown='UNKNOWN')
+
+    def test_lookup_miss(self):
+        from zope.interface import Interface
+        from zope.interface.registry import Components
+        from . import PredicateMismatch
+        class IFoo(Interface): pass
+        registry = Components()
+        domain = self._makeOne(IFoo, registry)
+        self.assertRaises(PredicateMismatch, domain.lookup, object())
+
+    def test_lookup_with_name(self):
+        from zope.interface import Interface
+        from zope.interface import implementer
+        from zope.interface.registry import Components
+        from . import PredicateMismatch
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        @implementer(IBar)
+        class Bar(object): pass
+        registry = Components()
+        candidate = object()
         domain = self._makeOne(IFoo, registry)
         domain.add_predicate('zero', DummyPredicate)
         domain.add_candidate(candidate, IBar, name='named', zero='ZERO')
@@ -588,6 +1878,340 @@ class PredicateDomainTests(unittest.TestCase):
         found = domain.lookup(Bar(), name='named')
         self.assertTrue(found is candidate)
 
+    def test_phash(self):
+        from zope.interface import Interface
+        from zope.interface import implementer
+        from zope.interface.registry import Components
+        from . import DEFAULT_PHASH
+        from . import MD5Phash
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        @implementer(IBar)
+        class Bar(object): pass
+        registry = Components()
+        domain = self._getTargetClass()(IFoo, registry, phash=MD5Phash)
+        domain.add_candidate('bar', IBar)
+        self.assertEqual(domain.lookup(Bar()), 'bar')
+        self.assertEqual(list(domain.by_phash), [DEFAULT_PHASH])
+
+    def test_freeze(self):
+        from zope.interface import Interface
+        from zope.interface import implementer
+        from zope.interface import providedBy
+        from zope.interface.registry import Components
+        from . import FrozenDomainError
+        from . import PredicateMismatch
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        @implementer(IBar)
+        class Bar(object): pass
+        registry = Components()
+        domain = self._makeOne(IFoo, registry)
+        domain.add_predicate('zero', DummyPredicate)
+        domain.add_predicate('one', PredicateOne)
+        domain.add_candidate('one', IBar, one='ONE', zero='ZERO')
+        domain.add_candidate('zero', IBar, zero='ZERO')
+        domain.add_candidate('named', IBar, name='named', one='ONE')
+        domain.freeze()
+        domain.freeze()
+        bar = Bar()
+        self.assertEqual(domain.lookup(bar), 'zero')
+        self.assertEqual(domain.lookup_for_specs([providedBy(bar)], bar),
+                         'zero')
+        self.assertEqual(domain.query(bar), 'zero')
+        self.assertRaises(PredicateMismatch, domain.lookup, bar, name='named')
+        self.assertRaises(PredicateMismatch, domain.lookup_for_specs,
+                          [providedBy(bar)], bar, name='named')
+        self.assertRaises(PredicateMismatch, domain.lookup, object())
+        self.assertEqual(domain.query(bar, name='named', default=1), 1)
+        self.assertEqual(domain.query(object(), default=1), 1)
+        self.assertEqual(list(domain.all(bar)), [('', 'zero')])
+        self.assertRaises(FrozenDomainError, domain.add_predicate,
+                          'two', PredicateTwo)
+        self.assertRaises(FrozenDomainError, domain.add_candidate,
+                          'zero', IBar)
+        self.assertRaises(FrozenDomainError, domain.add_candidates,
+                          [('zero', (IBar,), {})])
+        self.assertRaises(FrozenDomainError, domain.batch().__enter__)
+
+    def test_freeze_pack(self):
+        from zope.interface import Interface
+        from zope.interface import implementer
+        from zope.interface.registry import Components
+        from . import PackedDispatch
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        @implementer(IBar)
+        class Bar(object): pass
+        domain = self._makeOne(IFoo, Components())
+        domain.add_predicate('zero', DummyPredicate)
+        domain.add_candidate('zero', IBar, zero='ZERO')
+        domain.add_candidate('none', IBar)
+        domain.freeze(pack=True)
+        frozen = list(domain._frozen.values())
+        self.assertTrue(isinstance(frozen[0], PackedDispatch))
+        self.assertEqual(domain.lookup(Bar()), 'zero')
+
+    def test_prefork(self):
+        import gc
+        from zope.interface import Interface
+        from zope.interface import implementer
+        from zope.interface.registry import Components
+        from . import PackedDispatch
+        from . import prefork
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        @implementer(IBar)
+        class Bar(object): pass
+        one = self._makeOne(IFoo, Components())
+        one.add_candidate('one', IBar)
+        two = self._makeOne(IFoo, Components())
+        two.add_candidate('two', IBar)
+        two.freeze()
+        try:
+            prefork(one, two)
+            self.assertTrue(gc.get_freeze_count() > 0)
+        finally:
+            gc.unfreeze()
+        self.assertTrue(
+            isinstance(list(one._frozen.values())[0], PackedDispatch))
+        self.assertFalse(
+            isinstance(list(two._frozen.values())[0], PackedDispatch))
+        self.assertEqual(one.lookup(Bar()), 'one')
+        self.assertEqual(two.lookup(Bar()), 'two')
+
+    def test_freeze_within_batch(self):
+        from zope.interface import Interface
+        from zope.interface.registry import Components
+        from . import FrozenDomainError
+        class IFoo(Interface): pass
+        domain = self._makeOne(IFoo, Components())
+        with domain.batch():
+            self.assertRaises(FrozenDomainError, domain.freeze)
+
+    def test_freeze_with_matcher(self):
+        from zope.interface import Interface
+        from zope.interface import implementer
+        from zope.interface.registry import Components
+        from . import TreeMatcher
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        class IBaz(Interface): pass
+        @implementer(IBar, IBaz)
+        class Bar(object): pass
+        registry = Components()
+        domain = self._getTargetClass()(IFoo, registry, matcher=TreeMatcher)
+        domain.add_predicate('zero', DummyPredicate)
+        domain.add_candidate('bar', IBar, zero='ZERO')
+        domain.add_candidate('baz', IBaz, name='baz', zero='ZERO')
+        self.assertEqual(domain.lookup(Bar(), name='baz'), 'baz')
+        domain.freeze()
+        frozen = list(domain._frozen.values())
+        self.assertTrue(isinstance(frozen[0]._matcher, TreeMatcher))
+        self.assertTrue(
+            frozen[1]._matcher is domain._dispatches[1]._matcher[2])
+        self.assertEqual(domain.lookup(Bar()), 'bar')
+        self.assertEqual(list(domain.all(Bar())),
+                         [('baz', 'baz'), ('', 'bar')])
+
+    def test_concurrent_lookups(self):
+        import threading
+        from zope.interface import Interface
+        from zope.interface import implementer
+        from zope.interface.registry import Components
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        @implementer(IBar)
+        class Bar(object): pass
+        domain = self._makeOne(IFoo, Components())
+        domain.add_predicate('zero', DummyPredicate)
+        domain.add_candidate(0, IBar)
+        errors = []
+        done = threading.Event()
+        def read():
+            bar = Bar()
+            seen = 0
+            try:
+                while not done.is_set():
+                    # candidates all have the same order: the first one
+                    # registered with a predicate wins once it is there
+                    found = domain.lookup(bar)
+                    self.assertTrue(found in (seen, 10))
+                    seen = found
+                    for name, found in domain.all(bar):
+                        self.assertEqual(found % 10, int(name or 0))
+            except Exception as e: # pragma: no cover
+                errors.append(e)
+                done.set()
+        def write(start):
+            for i in range(start, 200, 2):
+                name = str(i % 10) if i % 10 else ''
+                domain.add_candidate(i, IBar, name=name, zero='ZERO%d' % i)
+        readers = [threading.Thread(target=read) for i in range(4)]
+        writers = [threading.Thread(target=write, args=(i,)) for i in (1, 2)]
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        done.set()
+        for thread in readers:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(domain.lookup(Bar()), 10)
+        self.assertEqual(len(domain.by_phash), 200)
+        self.assertEqual(
+            sum(len(dispatch.candidates) for dispatch in domain._dispatches),
+            200)
+
+    def test_lazy_predicate(self):
+        from zope.interface import Interface
+        from zope.interface import implementer
+        from zope.interface.registry import Components
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        @implementer(IBar)
+        class Bar(object): pass
+        created = []
+        def factory(val, api):
+            created.append(val)
+            return DummyPredicate(val, api)
+        registry = Components()
+        domain = self._makeOne(IFoo, registry)
+        domain.add_predicate('zero', factory, lazy=True)
+        domain.add_candidate('a', IBar, zero='A')
+        domain.add_candidate('b', IBar, name='b', zero='B')
+        self.assertEqual(created, [])
+        self.assertEqual(domain.lookup(Bar()), 'a')
+        self.assertEqual(domain.lookup(Bar()), 'a')
+        self.assertEqual(created, ['A'])
+
+    def test_lookup_for_specs(self):
+        from zope.interface import Interface
+        from zope.interface import implementer
+        from zope.interface import providedBy
+        from zope.interface.registry import Components
+        from . import PredicateMismatch
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        @implementer(IBar)
+        class Bar(object): pass
+        registry = Components()
+        candidate = object()
+        domain = self._makeOne(IFoo, registry)
+        domain.add_candidate(candidate, IBar, name='bar')
+        bar = Bar()
+        specs = [providedBy(bar)]
+        self.assertTrue(
+            domain.lookup_for_specs(specs, bar, name='bar') is candidate)
+        self.assertRaises(PredicateMismatch, domain.lookup_for_specs,
+                          specs, bar)
+        self.assertRaises(TypeError, domain.lookup_for_specs, specs)
+        self.assertRaises(TypeError, domain.lookup_for_specs, specs, bar,
+                          unknown='UNKNOWN')
+
+    def test_lookup_multiple_args(self):
+        from zope.interface import Interface
+        from zope.interface import implementer
+        from zope.interface.registry import Components
+        from . import PredicateMismatch
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        class IBaz(Interface): pass
+        @implementer(IBar)
+        class Bar(object): pass
+        @implementer(IBaz)
+        class Baz(object): pass
+        registry = Components()
+        domain = self._makeOne(IFoo, registry)
+        domain.add_candidate('two', IBar, IBaz)
+        domain.add_candidate('three', IBar, IBaz, IBar)
+        self.assertEqual(domain.lookup(Bar(), Baz()), 'two')
+        self.assertEqual(domain.lookup(Bar(), Baz(), Bar()), 'three')
+        self.assertRaises(PredicateMismatch, domain.lookup, Baz(), Bar())
+        self.assertEqual(list(domain.all(Bar(), Baz(), Bar())),
+                         [('', 'three')])
+
+    def test_lookup_directly_provided(self):
+        from zope.interface import Interface
+        from zope.interface import alsoProvides
+        from zope.interface import implementer
+        from zope.interface.registry import Components
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        class IBaz(Interface): pass
+        @implementer(IBar)
+        class Bar(object): pass
+        registry = Components()
+        domain = self._makeOne(IFoo, registry)
+        domain.add_candidate('bar', IBar)
+        domain.add_candidate('baz', IBaz)
+        bar = Bar()
+        self.assertEqual(domain.lookup(bar), 'bar')
+        alsoProvides(bar, IBaz)
+        self.assertEqual(domain.lookup(bar), 'baz')
+        self.assertEqual(domain.lookup(Bar()), 'bar')
+
+    def test_lookup_class_arg(self):
+        from zope.interface import Interface
+        from zope.interface import implementer
+        from zope.interface import provider
+        from zope.interface.registry import Components
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        class IBarFactory(Interface): pass
+        @provider(IBarFactory)
+        @implementer(IBar)
+        class Bar(object): pass
+        registry = Components()
+        domain = self._makeOne(IFoo, registry)
+        domain.add_candidate('bar', IBar)
+        domain.add_candidate('factory', IBarFactory)
+        self.assertEqual(domain.lookup(Bar()), 'bar')
+        self.assertEqual(domain.lookup(Bar), 'factory')
+
+    def test_query(self):
+        from zope.interface import Interface
+        from zope.interface import implementer
+        from zope.interface.registry import Components
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        @implementer(IBar)
+        class Bar(object): pass
+        registry = Components()
+        candidate = object()
+        default = object()
+        domain = self._makeOne(IFoo, registry)
+        domain.add_predicate('zero', DummyPredicate)
+        domain.add_predicate('one', PredicateOne)
+        domain.add_candidate(candidate, IBar, zero='ZERO')
+        domain.add_candidate(candidate, IBar, name='one', one='ONE')
+        self.assertTrue(domain.query(Bar()) is candidate)
+        self.assertTrue(domain.query(object()) is None)
+        self.assertTrue(domain.query(object(), default=default) is default)
+        self.assertTrue(domain.query(Bar(), name='one') is None)
+        self.assertTrue(
+            domain.query(Bar(), name='one', default=default) is default)
+        self.assertRaises(TypeError, domain.query)
+        self.assertRaises(TypeError, domain.query, Bar(), unknown='UNKNOWN')
+
+    def test_miss_then_add_candidate(self):
+        from zope.interface import Interface
+        from zope.interface import implementer
+        from zope.interface.registry import Components
+        from . import PredicateMismatch
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        @implementer(IBar)
+        class Bar(object): pass
+        registry = Components()
+        candidate = object()
+        domain = self._makeOne(IFoo, registry)
+        self.assertRaises(PredicateMismatch, domain.lookup, Bar())
+        self.assertTrue(domain.query(Bar()) is None)
+        domain.add_candidate(candidate, Bar)
+        self.assertTrue(domain.lookup(Bar()) is candidate)
+        self.assertTrue(domain.query(Bar()) is candidate)
+
     def test_all(self):
         from zope.interface import Interface
         from zope.interface import implementer
@@ -605,11 +2229,571 @@ class PredicateDomainTests(unittest.TestCase):
         domain.add_candidate(candidate1, IBar, name='name1', zero='ZERO')
         domain.add_candidate(candidate2, IBar, name='name2')
         domain.add_candidate(candidate2, IBar, name='name3', one='ONE')
-        self.assertEqual(sorted(domain.all(Bar())),
+        self.assertEqual(list(domain.all(Bar())),
                          [('name1', candidate1), ('name2', candidate2)])
 
 
 
+class SpecIndexPredicateDomainTests(PredicateDomainTests):
+
+    def _makeOne(self, target_interface, registry):
+        from . import SpecIndex
+        return self._getTargetClass()(target_interface, registry,
+                                      index=SpecIndex)
+
+
+class SnapshotTests(unittest.TestCase):
+
+    def _makeOne(self, **kw):
+        from zope.interface.registry import Components
+        from . import PredicateDomain
+        domain = PredicateDomain(ISnapshotTarget, Components(), **kw)
+        domain.add_predicate('zero', DummyPredicate)
+        domain.add_predicate('one', PredicateOne)
+        domain.add_predicate('keyed', KeyedPredicate)
+        return domain
+
+    def _configure(self, domain):
+        from . import not_
+        from . import predvalseq
+        domain.add_candidate(snapshot_view1, ISnapshotContext,
+                             zero='ZERO', one=not_('ONE'))
+        domain.add_candidate(snapshot_view2, SnapshotContext, name='named',
+                             keyed='POST')
+        domain.add_candidate(snapshot_view3, ISnapshotContext,
+                             keyed=['GET'], zero=None)
+        domain.add_candidate(snapshot_view3, ISnapshotContext, zero='ZERO')
+        domain.add_candidate(snapshot_view3, ISnapshotContext)
+        domain.add_candidate(snapshot_view3, ISnapshotContext, name='named',
+                             zero=predvalseq(['A', 'B']), keyed='POST')
+
+    def _snapshot(self, fingerprint='fp', **kw):
+        import json
+        domain = self._makeOne(record=True, **kw)
+        self._configure(domain)
+        return domain, json.loads(json.dumps(domain.snapshot(fingerprint)))
+
+    def test_restore(self):
+        from . import PredicateMismatch
+        configured, snapshot = self._snapshot()
+        self.assertEqual(snapshot['fingerprint'], 'fp')
+        self.assertEqual(snapshot['predicates'],
+                         [['zero', 'walkabout.tests:DummyPredicate'],
+                          ['one', 'walkabout.tests:PredicateOne'],
+                          ['keyed', 'walkabout.tests:KeyedPredicate']])
+        self.assertEqual(snapshot['values'].count(['zero', False, 'ZERO']), 1)
+        self.assertEqual(len(snapshot['lists']), 6)
+        self.assertEqual(len(snapshot['candidates']), 6)
+        domain = self._makeOne(record=True)
+        self.assertTrue(domain.restore(snapshot, 'fp'))
+        self.assertEqual(domain.by_phash.keys(), configured.by_phash.keys())
+        self.assertEqual(
+            [dispatch.candidates for dispatch in domain._dispatches],
+            [dispatch.candidates for dispatch in configured._dispatches])
+        for phash, preds in domain.by_phash.items():
+            self.assertEqual([pred.text() for pred in preds],
+                             [pred.text() for pred in
+                              configured.by_phash[phash]])
+        # the same predicate value is only created once
+        zeros = set(id(pred) for preds in domain.by_phash.values()
+                    for pred in preds
+                    if isinstance(pred, DummyPredicate) and pred.val == 'ZERO')
+        self.assertEqual(len(zeros), 1)
+        self.assertTrue(isinstance(domain.by_phash[
+            domain._dispatches[1].candidates[0][2]][0], KeyedPredicate))
+        self.assertEqual(domain.lookup(SnapshotContext()), snapshot_view1)
+        self.assertEqual(domain.lookup(SnapshotContext('POST'), name='named'),
+                         snapshot_view2)
+        self.assertRaises(PredicateMismatch, domain.lookup,
+                          SnapshotContext('PUT'), name='named')
+        self.assertEqual(domain.snapshot('fp'), snapshot)
+        self.assertTrue(self._makeOne().restore(snapshot, 'fp'))
+
+    def test_restore_keyed(self):
+        from . import Keyed
+        from . import KeyedMatcher
+        configured, snapshot = self._snapshot(matcher=KeyedMatcher)
+        domain = self._makeOne(matcher=KeyedMatcher)
+        self.assertTrue(domain.restore(snapshot, 'fp'))
+        self.assertTrue(isinstance(domain.by_phash[
+            domain._dispatches[1].candidates[0][2]][0], Keyed))
+        self.assertEqual(domain.lookup(SnapshotContext('POST'), name='named'),
+                         snapshot_view2)
+
+    def test_restore_interned(self):
+        configured, snapshot = self._snapshot()
+        domain = self._makeOne()
+        self.assertTrue(domain.restore(snapshot, 'fp'))
+        restored = domain.by_phash[domain._dispatches[0].candidates[0][2]]
+        order, preds, phash = domain.predicates.make(
+            domain.registry, zero='ZERO')
+        self.assertTrue(preds[0] is restored[0])
+
+    def test_restore_leaves_candidates_alone(self):
+        configured, snapshot = self._snapshot()
+        before = dict(snapshot_view1.__dict__)
+        self.assertTrue(self._makeOne().restore(snapshot, 'fp'))
+        self.assertEqual(snapshot_view1.__dict__, before)
+
+    def test_restore_within_batch(self):
+        configured, snapshot = self._snapshot()
+        domain = self._makeOne()
+        with domain.batch():
+            self.assertTrue(domain.restore(snapshot, 'fp'))
+            self.assertEqual(domain._dispatches, [])
+        self.assertEqual(len(domain._dispatches), 3)
+
+    def test_restore_lazy(self):
+        from . import LazyPredicate
+        configured, snapshot = self._snapshot()
+        domain = self._makeOne()
+        domain.add_predicate('zero', DummyPredicate, lazy=True)
+        self.assertTrue(domain.restore(snapshot, 'fp'))
+        preds = domain.by_phash[domain._dispatches[0].candidates[0][2]]
+        self.assertTrue(isinstance(preds[0], LazyPredicate))
+
+    def test_restore_mismatch(self):
+        from . import MD5Phash
+        configured, snapshot = self._snapshot()
+        domain = self._makeOne()
+        self.assertFalse(domain.restore(snapshot, 'other'))
+        self.assertFalse(domain.restore(dict(snapshot, version=2), 'fp'))
+        self.assertFalse(self._makeOne(phash=MD5Phash).restore(snapshot, 'fp'))
+        domain.add_predicate('two', PredicateTwo)
+        self.assertFalse(domain.restore(snapshot, 'fp'))
+        domain.add_predicate('one', PredicateTwo)
+        self.assertFalse(domain.restore(snapshot, 'fp'))
+        self.assertEqual(domain._dispatches, [])
+
+    def test_restore_md5(self):
+        from . import MD5Phash
+        configured, snapshot = self._snapshot(phash=MD5Phash)
+        self.assertEqual(snapshot['phash'], 'walkabout:MD5Phash')
+        domain = self._makeOne(phash=MD5Phash)
+        self.assertTrue(domain.restore(snapshot, 'fp'))
+        self.assertEqual(domain.by_phash.keys(), configured.by_phash.keys())
+
+    def test_restore_frozen(self):
+        from . import FrozenDomainError
+        configured, snapshot = self._snapshot()
+        domain = self._makeOne()
+        domain.freeze()
+        self.assertRaises(FrozenDomainError, domain.restore, snapshot, 'fp')
+
+    def test_snapshot_not_recording(self):
+        domain = self._makeOne()
+        self.assertRaises(ValueError, domain.snapshot, 'fp')
+
+    def test_snapshot_not_importable(self):
+        domain = self._makeOne(record=True)
+        domain.add_candidate(object(), ISnapshotContext)
+        self.assertRaises(ValueError, domain.snapshot, 'fp')
+        domain = self._makeOne(record=True)
+        domain.add_candidate(lambda: None, ISnapshotContext)
+        self.assertRaises(ValueError, domain.snapshot, 'fp')
+
+    def test_snapshot_not_json(self):
+        domain = self._makeOne(record=True)
+        domain.add_candidate(snapshot_view1, ISnapshotContext, zero=('a',))
+        self.assertRaises(ValueError, domain.snapshot, 'fp')
+        domain = self._makeOne(record=True)
+        domain.add_candidate(snapshot_view1, ISnapshotContext, one=b'a')
+        self.assertRaises(ValueError, domain.snapshot, 'fp')
+
+
+class RegistryIndexTests(unittest.TestCase):
+
+    def _makeOne(self, target_interface, registry):
+        from . import PredicateDomain
+        return PredicateDomain(target_interface, registry)
+
+    def _makeCountingRegistry(self):
+        from zope.interface.registry import Components
+        registry = Components()
+        calls = []
+        adapters = registry.adapters
+        lookup, lookupAll = adapters.lookup, adapters.lookupAll
+        def _lookup(*arg, **kw):
+            calls.append('lookup')
+            return lookup(*arg, **kw)
+        def _lookupAll(*arg, **kw):
+            calls.append('lookupAll')
+            return lookupAll(*arg, **kw)
+        adapters.lookup = _lookup
+        adapters.lookupAll = _lookupAll
+        return registry, calls
+
+    def test_lookup_cached(self):
+        from zope.interface import Interface
+        from zope.interface import implementer
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        class IBaz(IBar): pass
+        @implementer(IBaz)
+        class Baz(object): pass
+        registry, calls = self._makeCountingRegistry()
+        domain = self._makeOne(IFoo, registry)
+        candidate1 = object()
+        candidate2 = object()
+        domain.add_candidate(candidate1, IBar)
+        del calls[:]
+        self.assertTrue(domain.lookup(Baz()) is candidate1)
+        self.assertTrue(domain.lookup(Baz()) is candidate1)
+        self.assertEqual(calls, ['lookup'])
+        # registering a more specific dispatch invalidates the cache
+        domain.add_candidate(candidate2, IBaz, name='other')
+        domain.add_candidate(candidate2, Baz)
+        self.assertTrue(domain.lookup(Baz()) is candidate2)
+
+    def test_lookup_miss_cached(self):
+        from zope.interface import Interface
+        from . import PredicateMismatch
+        class IFoo(Interface): pass
+        registry, calls = self._makeCountingRegistry()
+        domain = self._makeOne(IFoo, registry)
+        self.assertRaises(PredicateMismatch, domain.lookup, object())
+        self.assertTrue(domain.query(object()) is None)
+        self.assertEqual(calls, ['lookup'])
+
+    def test_lookup_cache_invalidated_by_registry_change(self):
+        from zope.interface import Interface
+        from zope.interface import implementer
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        class IBaz(IBar): pass
+        @implementer(IBaz)
+        class Baz(object): pass
+        registry, calls = self._makeCountingRegistry()
+        domain = self._makeOne(IFoo, registry)
+        candidate1 = object()
+        candidate2 = object()
+        domain.add_candidate(candidate1, IBar)
+        self.assertTrue(domain.lookup(Baz()) is candidate1)
+        other = self._makeOne(IFoo, registry)
+        other.add_candidate(candidate2, IBaz)
+        self.assertTrue(domain.lookup(Baz()) is candidate2)
+
+    def test_lookup_cache_invalidated_by_declaration_change(self):
+        from zope.interface import Interface
+        from zope.interface import classImplements
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        class Bar(object): pass
+        registry, calls = self._makeCountingRegistry()
+        domain = self._makeOne(IFoo, registry)
+        candidate1 = object()
+        candidate2 = object()
+        domain.add_candidate(candidate1, Bar)
+        domain.add_candidate(candidate2, IBar, name='bar')
+        self.assertTrue(domain.lookup(Bar()) is candidate1)
+        self.assertEqual(list(domain.all(Bar())), [('', candidate1)])
+        self.assertTrue(domain.query(Bar(), name='bar') is None)
+        classImplements(Bar, IBar)
+        self.assertTrue(domain.lookup(Bar(), name='bar') is candidate2)
+        self.assertEqual(sorted(dict(domain.all(Bar()))), ['', 'bar'])
+
+    def test_lookup_not_cached_without_generation(self):
+        from zope.interface import Interface
+        from zope.interface import implementer
+        from zope.interface.registry import Components
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        @implementer(IBar)
+        class Bar(object): pass
+        class Adapters(object):
+            def __init__(self, adapters):
+                self.adapters = adapters
+            def __getattr__(self, name):
+                if name == '_generation':
+                    raise AttributeError(name)
+                return getattr(self.adapters, name)
+        registry = Components()
+        registry.adapters = Adapters(registry.adapters)
+        domain = self._makeOne(IFoo, registry)
+        candidate = object()
+        domain.add_candidate(candidate, IBar)
+        self.assertTrue(domain.lookup(Bar()) is candidate)
+        self.assertEqual(list(domain.all(Bar())), [('', candidate)])
+        self.assertTrue(domain.index._cache is None)
+
+    def test_all_cached(self):
+        from zope.interface import Interface
+        from zope.interface import implementer
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        @implementer(IBar)
+        class Bar(object): pass
+        registry, calls = self._makeCountingRegistry()
+        domain = self._makeOne(IFoo, registry)
+        candidate = object()
+        domain.add_candidate(candidate, IBar)
+        del calls[:]
+        self.assertEqual(list(domain.all(Bar())), [('', candidate)])
+        self.assertEqual(list(domain.all(Bar())), [('', candidate)])
+        self.assertEqual(calls, ['lookupAll'])
+
+    def test_freeze_shared_target_interface(self):
+        from zope.interface import Interface
+        from zope.interface import implementer
+        from zope.interface.registry import Components
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        @implementer(IBar)
+        class Bar(object): pass
+        registry = Components()
+        domain = self._makeOne(IFoo, registry)
+        other = self._makeOne(IFoo, registry)
+        other.add_candidate('bar', IBar)
+        domain.by_phash.update(other.by_phash)
+        domain.freeze()
+        self.assertEqual(domain.lookup(Bar()), 'bar')
+        self.assertEqual(len(domain._frozen), 1)
+
+
+class SpecIndexTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from . import SpecIndex
+        return SpecIndex
+
+    def _makeOne(self, target_interface):
+        return self._getTargetClass()(None, target_interface)
+
+    def _makeDomains(self, target_interface):
+        from zope.interface.registry import Components
+        from . import PredicateDomain
+        return (PredicateDomain(target_interface, Components()),
+                PredicateDomain(target_interface, Components(),
+                                index=self._getTargetClass()))
+
+    def test_same_resolution_as_registry(self):
+        from zope.interface import Interface
+        from zope.interface import implementer
+        from zope.interface import directlyProvides
+        class IFoo(Interface): pass
+        class IA(Interface): pass
+        class IB(IA): pass
+        class IC(Interface): pass
+        class ID(IC): pass
+        @implementer(IA)
+        class A(object): pass
+        @implementer(IB)
+        class B(A): pass
+        @implementer(IC)
+        class C(object): pass
+        @implementer(ID)
+        class D(C): pass
+        registrations = [
+            ((IA, IC), ''), ((IB, IC), ''), ((IA, ID), ''), ((A, D), 'a'),
+            ((IA, Interface), 'a'), ((Interface, ID), 'b'), ((B, C), 'b'),
+            ]
+        domains = self._makeDomains(IFoo)
+        for domain in domains:
+            for i, (required, name) in enumerate(registrations):
+                domain.add_candidate(i, *required, name=name)
+        d = D()
+        directlyProvides(d, IB)
+        objects = [A(), B(), C(), D(), d, object()]
+        for first in objects:
+            for second in objects:
+                expected, native = [
+                    list(domain.all(first, second)) for domain in domains]
+                self.assertEqual(native, expected)
+                for name in ('', 'a', 'b'):
+                    expected, native = [
+                        dict(domain.all(first, second)).get(name)
+                        for domain in domains]
+                    self.assertEqual(native, expected)
+
+    def test_all_order_like_registry(self):
+        from zope.interface import Interface
+        from zope.interface import implementer
+        class IFoo(Interface): pass
+        class IA(Interface): pass
+        class IB(IA): pass
+        @implementer(IB)
+        class B(object): pass
+        for domain in self._makeDomains(IFoo):
+            domain.add_candidate('x', IA, name='x')
+            domain.add_candidate('y', IB, name='y')
+            domain.add_candidate('z', IA, name='z')
+            self.assertEqual(list(domain.all(B())),
+                             [('x', 'x'), ('z', 'z'), ('y', 'y')])
+
+    def test_find_inherits_like_registry(self):
+        from zope.interface import Interface
+        from zope.interface import implementer
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        class IBaz(IBar): pass
+        @implementer(IBaz)
+        class Baz(object): pass
+        for domain in self._makeDomains(IFoo):
+            domain.add_predicate('one', PredicateOne)
+            domain.add_candidate('bar', IBar)
+            # lands in IBar's dispatch, where the unpredicated 'bar' wins
+            domain.add_candidate('baz', IBaz, one=True)
+            self.assertEqual(domain.lookup(Baz()), 'bar')
+            self.assertTrue(
+                domain.index.find((IBaz,), '') is
+                domain.index.find((IBar,), ''))
+
+    def test_lookup_cached(self):
+        from zope.interface import Interface
+        from zope.interface import implementedBy
+        from zope.interface import implementer
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        @implementer(IBar)
+        class Bar(object): pass
+        index = self._makeOne(IFoo)
+        dispatch = object()
+        index.register((IBar,), '', dispatch)
+        specs = (implementedBy(Bar),)
+        self.assertTrue(index.lookup(specs, '') is dispatch)
+        self.assertEqual(index.lookup_all(specs), (('', dispatch),))
+        index.find = index._find_all = None # not called again
+        self.assertTrue(index.lookup(specs, '') is dispatch)
+        self.assertEqual(index.lookup_all(specs), (('', dispatch),))
+
+    def test_lookup_miss(self):
+        from zope.interface import Interface
+        from zope.interface import implementedBy
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        index = self._makeOne(IFoo)
+        specs = (implementedBy(object),)
+        self.assertTrue(index.lookup(specs, '') is None)
+        self.assertEqual(index.lookup_all(specs), ())
+        index.register((IBar,), '', object())
+        self.assertTrue(index.lookup(specs, '') is None)
+        self.assertTrue(index.lookup((IBar, IBar), '') is None)
+        self.assertEqual(index.lookup_all(()), ())
+
+    def test_lookup_miss_cached(self):
+        from zope.interface import Interface
+        from zope.interface import implementedBy
+        class IFoo(Interface): pass
+        index = self._makeOne(IFoo)
+        specs = (implementedBy(object),)
+        self.assertTrue(index.lookup(specs, '') is None)
+        index.find = None # not called again
+        self.assertTrue(index.lookup(specs, '') is None)
+
+    def test_register_invalidates(self):
+        from zope.interface import Interface
+        from zope.interface import implementedBy
+        from zope.interface import implementer
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        @implementer(IBar)
+        class Bar(object): pass
+        index = self._makeOne(IFoo)
+        dispatch1 = object()
+        dispatch2 = object()
+        specs = (implementedBy(Bar),)
+        index.register((IBar,), '', dispatch1)
+        self.assertTrue(index.lookup(specs, '') is dispatch1)
+        self.assertEqual(index.lookup_all(specs), (('', dispatch1),))
+        index.register((implementedBy(Bar),), '', dispatch2)
+        self.assertTrue(index.lookup(specs, '') is dispatch2)
+        self.assertEqual(index.lookup_all(specs), (('', dispatch2),))
+
+    def test_declaration_change_invalidates(self):
+        from zope.interface import Interface
+        from zope.interface import classImplements
+        from zope.interface import implementedBy
+        class IFoo(Interface): pass
+        class IBar(Interface): pass
+        class Bar(object): pass
+        index = self._makeOne(IFoo)
+        dispatch = object()
+        specs = (implementedBy(Bar),)
+        index.register((IBar,), 'bar', dispatch)
+        self.assertEqual(index.lookup_all(specs), ())
+        self.assertTrue(index.lookup(specs, 'bar') is None)
+        classImplements(Bar, IBar)
+        self.assertTrue(index.lookup(specs, 'bar') is dispatch)
+        self.assertEqual(index.lookup_all(specs), (('bar', dispatch),))
+
+
+class ClassSpecTests(unittest.TestCase):
+
+    def _callFUT(self, cls):
+        from . import _class_spec
+        return _class_spec(cls)
+
+    def test_plain_class(self):
+        from zope.interface import implementedBy
+        class Foo(object): pass
+        self.assertTrue(self._callFUT(Foo) is implementedBy(Foo))
+
+    def test_implementer(self):
+        from zope.interface import Interface
+        from zope.interface import implementedBy
+        from zope.interface import implementer
+        from zope.interface import providedBy
+        class IFoo(Interface): pass
+        @implementer(IFoo)
+        class Foo(object): pass
+        class Bar(Foo): pass
+        self.assertTrue(self._callFUT(Foo) is implementedBy(Foo))
+        self.assertTrue(self._callFUT(Bar) is providedBy(Bar()))
+
+    def test_slots(self):
+        from zope.interface import implementedBy
+        class Foo(object):
+            __slots__ = ()
+        self.assertTrue(self._callFUT(Foo) is implementedBy(Foo))
+
+    def test_metaclass(self):
+        class Meta(type): pass
+        self.assertTrue(self._callFUT(type) is False)
+        self.assertTrue(self._callFUT(Meta) is False)
+
+    def test_getattr(self):
+        class Foo(object):
+            def __getattr__(self, name):
+                raise AttributeError(name)
+        self.assertRaises(AttributeError, getattr, Foo(), 'nonesuch')
+        self.assertTrue(self._callFUT(Foo) is False)
+
+    def test_getattribute(self):
+        class Foo(object):
+            def __getattribute__(self, name):
+                return object.__getattribute__(self, name)
+        self.assertEqual(Foo().__dict__, {})
+        self.assertTrue(self._callFUT(Foo) is False)
+
+    def test_class_property(self):
+        class Foo(object):
+            @property
+            def __class__(self):
+                return object
+        self.assertTrue(Foo().__class__ is object)
+        self.assertTrue(self._callFUT(Foo) is False)
+
+    def test_provided_by(self):
+        class Foo(object):
+            __providedBy__ = None
+        class Bar(object):
+            @property
+            def __providedBy__(self):
+                raise AttributeError('__providedBy__')
+        self.assertRaises(AttributeError, getattr, Bar(), '__providedBy__')
+        self.assertTrue(self._callFUT(Foo) is not False)
+        self.assertTrue(self._callFUT(Bar) is False)
+
+    def test_provides(self):
+        from zope.interface import Interface
+        from zope.interface import Provides
+        class IFoo(Interface): pass
+        class Foo(object): pass
+        Foo.__provides__ = Provides(Foo, IFoo)
+        self.assertTrue(self._callFUT(Foo) is False)
+
+
+
 class DummyPredicate(object):
     def __init__(self, val, api):
         self.val = val
@@ -646,3 +2830,42 @@ class PredicateThree(object):
     def phash(self):
         return 'three: %s' % self.val
     text = phash
+
+
+class KeyedPredicate(object):
+    def __init__(self, val, api):
+        self.val = val
+        self.calls = api
+    def dispatch_key(self, request):
+        return request.method
+    def __call__(self, request):
+        if isinstance(self.calls, list):
+            self.calls.append(self.val)
+        return self.dispatch_key(request) == self.val
+    def phash(self):
+        return 'method = %s' % (self.val,)
+    text = phash
+
+
+class DummyRequest(object):
+    def __init__(self, method):
+        self.method = method
+
+
+class ISnapshotTarget(Interface):
+    pass
+
+
+class ISnapshotContext(Interface):
+    pass
+
+
+@implementer(ISnapshotContext)
+class SnapshotContext(object):
+    def __init__(self, method=None):
+        self.method = method
+
+
+def snapshot_view1(): pass
+def snapshot_view2(): pass
+def snapshot_view3(): pass